@@ -1,37 +1,48 @@
-import os
-
 from kwiq.core.flow import Flow
-from kwiq.task.apply_renames import ApplyRenames
-from kwiq.task.run_command import RunCommand
 
-from smart_code_merge.commons import AppConfig
+from smart_code_merge.commons import AppConfig, run_command, run_projects
+from smart_code_merge.rename_engine import RenameEngine, read_rename_mapping
+from smart_code_merge.word_index import WordIndex
 
 
 class ApplyTransformation(Flow):
     name: str = "apply-transformation"
 
-    def fn(self, config: AppConfig) -> None:
-        working_dir = config.working_dir
+    def fn(self, config: AppConfig, workers: int = 1) -> None:
+        """
+        Apply rename_mapping.csv to every project and commit the result. The files of all projects
+        are renamed in one pool of workers processes, the commits run on up to workers threads.
+        """
+        working_dir = config.working_dir.resolve()
 
-        mapping_file = (working_dir / "rename_mapping.csv").resolve()
+        mapping_file = (working_dir / "rename_mapping.csv")
 
         # for each project
         #   step 5: apply transformation
         #   step 6: commit code
         #   step 7: apply 3 way merge
-        for project in config.projects:
-            project_directory = (working_dir / f"__{project.key}" / "merge_dir").resolve()
-            os.chdir(project_directory)
+        def project_directory(project):
+            return working_dir / f"__{project.key}" / "merge_dir"
+
+        # # cleaning step
+        # run_command("git reset --hard", cwd=project_directory(project))
 
-            # # cleaning step
-            # RunCommand().execute(command="git reset --hard")
+        # run_command("git checkout remote", cwd=project_directory(project))
 
-            # RunCommand().execute(command="git checkout remote")
+        # cleaning step
+        # run_command("git reset --hard HEAD~1", cwd=project_directory(project))
 
-            # cleaning step
-            # RunCommand().execute(command="git reset --hard HEAD~1")
+        renames = read_rename_mapping(mapping_file)
+        file_paths = list(WordIndex.walk_files([project_directory(project) for project in config.projects]))
+        stats = RenameEngine(renames).rename_files(file_paths, workers)
+        seconds = max(stats['seconds'], 1e-9)
+        print(f"Renamed {len(renames)} words in {stats['files']} files in {stats['seconds']:.2f}s: "
+              f"{stats['files_touched']} files touched, {stats['replacements']} replacements "
+              f"({stats['replacements'] / seconds:.0f}/s, {stats['files'] / seconds:.0f} files/s), "
+              f"{stats['files_without_candidates']} without candidates, {stats['files_binary']} binary")
 
-            ApplyRenames().execute(mapping_csv_path=mapping_file, search_directory=project_directory)
+        def commit(project):
+            run_command('git add .', cwd=project_directory(project))
+            run_command('git commit -m "post transformation version"', cwd=project_directory(project))
 
-            RunCommand().execute(command='git add .')
-            RunCommand().execute(command=f'git commit -m "post transformation version"')
+        run_projects(config.projects, commit, workers)
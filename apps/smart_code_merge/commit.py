@@ -1,36 +1,42 @@
-import os
+from functools import partial
+from pathlib import Path
 
 from kwiq.core.flow import Flow
 from kwiq.core.utils import current_date
 from kwiq.task.clean_directory import CleanDirectory
 from kwiq.task.copy_directory import CopyDirectory
-from kwiq.task.run_command import RunCommand
-from smart_code_merge.commons import AppConfig
+from smart_code_merge.commons import AppConfig, ProjectConfig, run_command, run_projects
 
 
 class Commit(Flow):
     name: str = "commit"
 
     #   step 9: check-in merges to respective projects
-    def fn(self, config: AppConfig, target_branch_name: str = f"upstream_merge_{current_date()}") -> None:
-        working_dir = config.working_dir
-        for project in config.projects:
-            target_directory = project.local_project_path
-
-            # git checkout - b target_branch_name
-            os.chdir(target_directory)
-            RunCommand().execute(command=f'git checkout -b {target_branch_name}')
-
-            # clean dir
-            CleanDirectory().execute(directory=target_directory, filter=lambda i: i == ".git")
-
-            project_directory = (working_dir / f"__{project.key}" / "merge_dir").resolve()
-
-            # copy dir
-            CopyDirectory().execute(src_directory=project_directory,
-                                    dest_directory=target_directory,
-                                    filter=lambda i: i == ".git")
-
-            RunCommand().execute(command='git add .')
-            RunCommand().execute(command=f'git commit --allow-empty -m "{target_branch_name} version"')
-            RunCommand().execute(command=f'git push origin {target_branch_name}')
+    def fn(self, config: AppConfig, target_branch_name: str = f"upstream_merge_{current_date()}",
+           workers: int = 1) -> None:
+        working_dir = config.working_dir.resolve()
+        # CleanDirectory and CopyDirectory may work in the current directory, so every project runs
+        # in a process of its own, in its local project directory
+        run_projects(config.projects, partial(Commit.commit_project, working_dir, target_branch_name), workers,
+                     cwd=lambda project: project.local_project_path.resolve())
+
+    @classmethod
+    def commit_project(cls, working_dir: Path, target_branch_name: str, project: ProjectConfig) -> None:
+        target_directory = project.local_project_path.resolve()
+
+        # git checkout - b target_branch_name
+        run_command(f'git checkout -b {target_branch_name}', cwd=target_directory)
+
+        # clean dir
+        CleanDirectory().execute(directory=target_directory, filter=lambda i: i == ".git")
+
+        project_directory = (working_dir / f"__{project.key}" / "merge_dir")
+
+        # copy dir
+        CopyDirectory().execute(src_directory=project_directory,
+                                dest_directory=target_directory,
+                                filter=lambda i: i == ".git")
+
+        run_command('git add .', cwd=target_directory)
+        run_command(f'git commit --allow-empty -m "{target_branch_name} version"', cwd=target_directory)
+        run_command(f'git push origin {target_branch_name}', cwd=target_directory)
@@ -1,5 +1,10 @@
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, TypeVar
 
 from pydantic import BaseModel
 
@@ -20,3 +25,164 @@ class AppConfig(BaseModel):
     working_dir: Path
     projects: List[ProjectConfig]
     rename_words_regex: str
+
+
+T = TypeVar('T')
+
+
+# Key of the project the current thread runs for, set by run_projects for threaded projects
+_current_project = threading.local()
+_log_lock = threading.Lock()
+
+
+def log(message: str) -> None:
+    """
+    Prints message for the project the calling thread runs, every line prefixed with [project key]
+    so the logs of projects running side by side stay readable, and whole under concurrent writers.
+    Outside a threaded project, such as in a pool process whose stdout is tagged already, it prints as is.
+    """
+    key = getattr(_current_project, 'key', None)
+    text = str(message)
+    if key is not None:
+        text = '\n'.join(f"[{key}] {line}" for line in text.split('\n'))
+    with _log_lock:
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
+
+
+class ProjectTaggedOutput:
+    """
+    Stands in for sys.stdout in a pool process while it runs a project, prefixing every line printed,
+    by the kwiq tasks as well, with [project key]. Only output written through sys.stdout is tagged:
+    output written straight to the file descriptor, by child processes inheriting it for instance, and
+    logging handlers bound to the original stream before the swap pass through untagged. Threads of the
+    main process share sys.stdout, so threaded projects tag their lines through log instead.
+    """
+
+    def __init__(self, stream, key: str):
+        self.stream = stream
+        self.key = key
+        self._buffer = ""
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        # whole lines only, so lines of different pool processes do not interleave mid-line
+        with self._lock:
+            *lines, self._buffer = (self._buffer + text).split('\n')
+            if lines:
+                self.stream.write(''.join(f"[{self.key}] {line}\n" for line in lines))
+                # pool processes share the terminal, a flush per batch of lines keeps their lines whole
+                self.stream.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._buffer:
+                self.stream.write(f"[{self.key}] {self._buffer}\n")
+                self._buffer = ""
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_command(command: str, cwd: Path, quiet: bool = False) -> str:
+    """
+    Runs a shell command in cwd, without changing the working directory of the process,
+    prints its output unless quiet and raises if it fails. Returns the standard output.
+    """
+    result = subprocess.run(command, shell=True, cwd=cwd, capture_output=True, text=True)
+    output = (result.stdout + result.stderr).rstrip()
+    if output and (not quiet or result.returncode != 0):
+        log(output)
+    if result.returncode != 0:
+        raise RuntimeError(f"Command failed with exit code {result.returncode} in {cwd}: {command}")
+    return result.stdout
+
+
+class ProjectsFailedError(RuntimeError):
+    """
+    Raised by run_projects when projects failed; results holds those of the projects that did not.
+    """
+
+    def __init__(self, message: str, results: dict):
+        super().__init__(message)
+        self.results = results
+
+
+def run_projects(projects: List[ProjectConfig], fn: Callable[[ProjectConfig], T], workers: int = 1,
+                 cwd: Optional[Callable[[ProjectConfig], Path]] = None) -> Dict[str, T]:
+    """
+    Runs fn for every project, on up to workers threads, and returns the results by project key.
+    Without cwd, fn must work with explicit paths: it shares the process, and its working directory,
+    with the other projects and the caller.
+    With cwd, the working directory of a project, fn is for steps that work in the current directory,
+    such as the kwiq tasks: every project runs in a pool process of up to workers, even with one worker,
+    after changing into its directory, so the working directory of the caller never changes; fn must
+    then be picklable.
+    A failing project does not stop the others; the failures are raised together at the end.
+    """
+    workers = max(1, min(workers, len(projects)))
+    if cwd is None:
+        outcomes = run_in_threads(projects, fn, workers)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(run_in_directory, [fn] * len(projects), projects,
+                                         [cwd(project) for project in projects]))
+
+    results = {}
+    failures = []
+    for project, outcome in zip(projects, outcomes):
+        if isinstance(outcome, Exception):
+            failures.append(f"{project.key}: {outcome}")
+        else:
+            results[project.key] = outcome
+
+    if failures:
+        raise ProjectsFailedError(f"{len(failures)} of {len(projects)} projects failed:\n" + "\n".join(failures),
+                                  results)
+    return results
+
+
+def run_project(fn: Callable[[ProjectConfig], T], project: ProjectConfig):
+    try:
+        return fn(project)
+    except Exception as e:
+        log(f"Failed: {e!r}")
+        # outcomes of pool processes are pickled, which not every exception survives
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+def run_in_threads(projects: List[ProjectConfig], fn: Callable[[ProjectConfig], T], workers: int) -> list:
+    def run_tagged(project: ProjectConfig):
+        _current_project.key = project.key
+        try:
+            return run_project(fn, project)
+        finally:
+            _current_project.key = None
+
+    if workers == 1:
+        return [run_tagged(project) for project in projects]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_tagged, projects))
+
+
+def run_in_directory(fn: Callable[[ProjectConfig], T], project: ProjectConfig, directory: Path):
+    """
+    Runs fn for the project in directory, with stdout tagged, restoring both afterwards. In a pool
+    process a project is the only thing running, so these process-wide changes cannot affect another.
+    """
+    previous_stdout = sys.stdout
+    previous_directory = os.getcwd()
+    sys.stdout = ProjectTaggedOutput(previous_stdout, project.key)
+
+    def run_in(project: ProjectConfig):
+        os.chdir(directory)
+        return fn(project)
+
+    try:
+        return run_project(run_in, project)
+    finally:
+        sys.stdout.flush()
+        os.chdir(previous_directory)
+        sys.stdout = previous_stdout
@@ -1,33 +1,38 @@
-import os
+from functools import partial
+from pathlib import Path
 
 from kwiq.core.flow import Flow
 from kwiq.task.apply_3_way_merge import ApplyThreeWayMerge
-from smart_code_merge.commons import AppConfig
+from smart_code_merge.commons import AppConfig, ProjectConfig, run_projects
 
 
 class Merge(Flow):
     name: str = "merge"
 
-    def fn(self, config: AppConfig) -> None:
-        working_dir = config.working_dir
+    def fn(self, config: AppConfig, workers: int = 1) -> None:
+        working_dir = config.working_dir.resolve()
 
         # for each project
         #   step 5: apply transformation
         #   step 6: commit code
         #   step 7: apply 3 way merge
-        for project in config.projects:
-            # # cleaning step
-            # RunCommand().execute(command="git reset --hard")
+        # ApplyThreeWayMerge may work in the current directory, so every project runs in a process of its own
+        run_projects(config.projects, partial(Merge.merge_project, working_dir), workers,
+                     cwd=lambda project: working_dir)
 
-            # RunCommand().execute(command="git checkout remote")
+        # HUMAN STEP
+        #   step 8: merge conflicts manually
+        # HUMAN STEP
 
-            # cleaning step
-            # RunCommand().execute(command="git reset --hard HEAD~1")
+    @classmethod
+    def merge_project(cls, working_dir: Path, project: ProjectConfig) -> None:
+        # # cleaning step
+        # run_command("git reset --hard", cwd=base_dir / "merge_dir")
 
-            os.chdir(working_dir)
-            base_dir = (working_dir / f"__{project.key}")
-            ApplyThreeWayMerge().execute(base_dir=base_dir)
+        # run_command("git checkout remote", cwd=base_dir / "merge_dir")
 
-            # HUMAN STEP
-            #   step 8: merge conflicts manually
-            # HUMAN STEP
+        # cleaning step
+        # run_command("git reset --hard HEAD~1", cwd=base_dir / "merge_dir")
+
+        base_dir = (working_dir / f"__{project.key}")
+        ApplyThreeWayMerge().execute(base_dir=base_dir)
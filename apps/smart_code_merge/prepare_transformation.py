@@ -1,38 +1,45 @@
-import os
 from typing import List
 
 from kwiq.core.flow import Flow
 from kwiq.task import apply_renames
 from kwiq.task.csv_writer import write_data_to_csv
-from kwiq.task.extract_words import ExtractWords
-from kwiq.task.run_command import RunCommand
 
 from smart_code_merge.commons import AppConfig
+from smart_code_merge.word_index import WordIndex
+
+WORD_INDEX_FILE_NAME = "word_index.json"
 
 
 class PrepareTransformation(Flow):
     name: str = "prepare-transformation"
 
-    def fn(self, config: AppConfig) -> None:
-        working_dir = config.working_dir
+    def fn(self, config: AppConfig, workers: int = 1, reindex: bool = False) -> None:
+        """
+        Extract the words matching rename_words_regex from every project into word_index.json and
+        input_mapping.csv. All projects are scanned in one pool of workers processes; files unchanged
+        since the last run are taken from the index unless reindex.
+        """
+        working_dir = config.working_dir.resolve()
 
         # for each project
         #   step 2: checkout remote
         #   step 3: extract words for rename
-        unique_words = set()
-        for project in config.projects:
-            project_directory = (working_dir / f"__{project.key}" / "merge_dir").resolve()
-            os.chdir(project_directory)
-            # RunCommand().execute(command="git checkout local")
-            words = ExtractWords().execute(words_regex=config.rename_words_regex, search_directory=project_directory)
-            unique_words = unique_words.union(words)
+        project_directories = [(working_dir / f"__{project.key}" / "merge_dir") for project in config.projects]
+        word_index = WordIndex(working_dir / WORD_INDEX_FILE_NAME, config.rename_words_regex, working_dir)
+        if not reindex:
+            word_index.load()
+        stats = word_index.update(project_directories, workers)
+        word_index.save()
+        print(f"Indexed {stats['files']} files in {stats['seconds']:.2f}s: {stats['files_scanned']} scanned "
+              f"({stats['bytes_scanned']} bytes, {stats['files_binary']} binary), "
+              f"{stats['files_unchanged']} unchanged, {stats['words']} unique words")
 
         mapping_file = (working_dir / "input_mapping.csv")
 
         mapping_list: List[apply_renames.MappingData] = [
             apply_renames.MappingData(original_word=word, renamed_word=word)
             for word
-            in unique_words]
+            in sorted(word_index.words)]
 
         write_data_to_csv(mapping_list, mapping_file)
 
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from smart_code_merge.commons import log, run_command
+
+# Characters kept from a repository url in the name of its cache directory
+CACHE_NAME_PATTERN = re.compile(r'[^A-Za-z0-9._-]+')
+# Identity of the single commit of a materialized snapshot
+SNAPSHOT_GIT_IDENTITY = '-c user.name=smart-code-merge -c user.email=smart-code-merge@localhost'
+
+
+class RepositoryCache:
+    """
+    Persistent bare repositories under cache_dir, one per repository url, that keep the objects of
+    every branch fetched so far. Fetching a branch again only downloads the commits it gained, and
+    merge trees are cloned from the cache on the local file system instead of from the remote.
+    Projects sharing a url share its cache, which the setup fetches once for all of them; fetches into
+    the same cache are serialized.
+
+    Fetches can be partial (blob:none, blobs are downloaded when a checkout needs them) and shallow.
+    A partial cache cannot be cloned from directly, so its branches are materialized as snapshots:
+    a sparse worktree of the cache limited to a sub path, copied into a fresh single commit repository.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self._locks: Dict[Path, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def path_for(self, url: str) -> Path:
+        name = CACHE_NAME_PATTERN.sub('_', url.rstrip('/').split('/')[-1] or 'repository')
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+        return self.cache_dir / f"{name}-{digest}.git"
+
+    def lock_for(self, cache_path: Path) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(cache_path, threading.Lock())
+
+    def fetch(self, url: str, branches: List[str], depth: int = 0, partial_clone: bool = False,
+              stats: Optional[dict] = None) -> Dict[str, str]:
+        """
+        Updates the named branches of the cache of url from the remote and returns the commit of each.
+        """
+        cache_path = self.path_for(url)
+        branches = sorted(set(branches))
+        with self.lock_for(cache_path), RepositoryCache.track_fetched_bytes(cache_path, stats):
+            if not os.path.exists(cache_path / "HEAD"):
+                os.makedirs(cache_path, exist_ok=True)
+                run_command('git init --bare --quiet', cwd=cache_path)
+            # a named remote, so lazily fetched blobs of a partial cache know where to come from;
+            # local paths as file urls, git ignores filter and depth for plain local paths
+            remote_url = Path(url).as_uri() if os.path.isabs(url) else url
+            run_command(f'git config remote.origin.url "{remote_url}"', cwd=cache_path)
+
+            options = ['--quiet', '--no-tags']
+            if partial_clone:
+                options.append('--filter=blob:none')
+            if depth:
+                options.append(f'--depth={depth}')
+            elif os.path.exists(cache_path / "shallow"):
+                # full history asked of a cache fetched shallow before
+                options.append('--unshallow')
+            log(f"Fetching {', '.join(branches)} from {url}")
+            run_command(f'git fetch {" ".join(options)} origin {RepositoryCache.refspecs(branches)}', cwd=cache_path)
+
+            return {
+                branch: run_command(f'git rev-parse refs/heads/{branch}', cwd=cache_path, quiet=True).strip()
+                for branch in branches
+            }
+
+    def is_partial(self, url: str) -> bool:
+        """
+        Whether the cache of url was ever fetched without blobs, in which case it cannot be cloned from.
+        """
+        cache_path = self.path_for(url)
+        with self.lock_for(cache_path):
+            try:
+                return run_command('git config remote.origin.promisor', cwd=cache_path, quiet=True).strip() == 'true'
+            except RuntimeError:
+                return False
+
+    def reach_merge_base(self, url: str, branch: str, other_branch: str, depth: int,
+                         stats: Optional[dict] = None) -> Optional[str]:
+        """
+        Deepens a shallow fetch of two branches, doubling the depth each time, until their merge base
+        is in the cache, and returns it; None when the branches have no common history.
+        """
+        cache_path = self.path_for(url)
+        with self.lock_for(cache_path), RepositoryCache.track_fetched_bytes(cache_path, stats):
+            deepen = max(1, depth)
+            while True:
+                try:
+                    return run_command(f'git merge-base refs/heads/{branch} refs/heads/{other_branch}',
+                                       cwd=cache_path, quiet=True).strip()
+                except RuntimeError:
+                    shallow = run_command('git rev-parse --is-shallow-repository', cwd=cache_path, quiet=True)
+                    if shallow.strip() != 'true':
+                        return None
+
+                log(f"No merge base of {branch} and {other_branch} yet, deepening by {deepen}")
+                run_command(f'git fetch --quiet --no-tags --deepen={deepen} origin '
+                            f'{RepositoryCache.refspecs([branch, other_branch])}', cwd=cache_path)
+                deepen *= 2
+
+    def materialize(self, url: str, branch: str, sub_path: str, output_dir: Path,
+                    stats: Optional[dict] = None) -> Path:
+        """
+        Writes the tree of branch, limited to sub_path when there is one, as a new repository with
+        a single commit on branch in output_dir, and returns output_dir.
+        """
+        cache_path = self.path_for(url)
+        worktree_dir = output_dir.with_name(output_dir.name + ".worktree")
+        with self.lock_for(cache_path), RepositoryCache.track_fetched_bytes(cache_path, stats):
+            shutil.rmtree(worktree_dir, ignore_errors=True)
+            run_command('git worktree prune', cwd=cache_path)
+            run_command(f'git worktree add --quiet --no-checkout --detach "{worktree_dir}" refs/heads/{branch}',
+                        cwd=cache_path)
+            try:
+                if sub_path:
+                    run_command(f'git sparse-checkout set "{sub_path}"', cwd=worktree_dir)
+                # the checkout fetches the blobs a partial cache is missing, in one batch
+                run_command(f'git checkout --quiet --detach refs/heads/{branch}', cwd=worktree_dir)
+
+                shutil.copytree(worktree_dir, output_dir, ignore=shutil.ignore_patterns('.git'))
+            finally:
+                run_command(f'git worktree remove --force "{worktree_dir}"', cwd=cache_path)
+
+        run_command(f'git init --quiet --initial-branch="{branch}"', cwd=output_dir)
+        run_command('git add --all', cwd=output_dir)
+        run_command(f'git {SNAPSHOT_GIT_IDENTITY} commit --quiet --allow-empty -m "Snapshot of {branch} of {url}"',
+                    cwd=output_dir)
+        return output_dir
+
+    @classmethod
+    def refspecs(cls, branches: List[str]) -> str:
+        return ' '.join(f'+refs/heads/{branch}:refs/heads/{branch}' for branch in branches)
+
+    @classmethod
+    @contextmanager
+    def track_fetched_bytes(cls, cache_path: Path, stats: Optional[dict]):
+        """
+        Adds the growth of the object store of the cache to stats['bytes_fetched'].
+        """
+        if stats is None:
+            yield
+            return
+
+        before = RepositoryCache.object_bytes(cache_path)
+        try:
+            yield
+        finally:
+            stats['bytes_fetched'] = stats.get('bytes_fetched', 0) + max(0, RepositoryCache.object_bytes(cache_path) - before)
+
+    @classmethod
+    def object_bytes(cls, cache_path: Path) -> int:
+        total = 0
+        for directory, _, file_names in os.walk(cache_path / "objects"):
+            for file_name in file_names:
+                total += os.path.getsize(os.path.join(directory, file_name))
+        return total
@@ -1,41 +1,379 @@
+import hashlib
+import json
 import os
+import re
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from kwiq.core.flow import Flow
 from kwiq.task.setup_3_way_merge import MergeRepoInfos, RepoInfo, SetupThreeWayMerge
 
-from smart_code_merge.commons import AppConfig
+from smart_code_merge.commons import AppConfig, ProjectConfig, ProjectsFailedError, log, run_command, run_projects
+from smart_code_merge.repository_cache import RepositoryCache
+
+# scp-like git remotes, such as git@github.com:org/repo.git
+SCP_LIKE_REMOTE_PATTERN = re.compile(r'^[\w.-]+@[\w.-]+:')
+# Per project, the configuration and branch commits its checkouts were set up from,
+# and a digest of the checkouts right after
+SETUP_STATE_FILE_NAME = "setup_state.json"
+# Snapshots of partial or sparse branches, until SetupThreeWayMerge has cloned them
+SNAPSHOTS_DIR_NAME = ".snapshots"
 
 
 class Setup(Flow):
     name: str = "setup"
 
-    def fn(self, config: AppConfig) -> None:
-        working_dir = config.working_dir
-        print(f"Cleaning directory: {working_dir}")
-        shutil.rmtree(working_dir, ignore_errors=True)
+    def fn(self, config: AppConfig, workers: int = 1, incremental: bool = False,
+           cache_dir: Optional[Path] = None, partial_clone: bool = False, sparse: bool = False,
+           depth: int = 0) -> None:
+        """
+        Set up the base, local and remote checkouts of every project for a three way merge.
+        With incremental the working directory is kept: branches are fetched into bare repository caches
+        under cache_dir (working_dir/.cache by default), every repository once for all the projects using it,
+        and only projects whose configuration, branch
+        commits or checkouts changed since the last setup are set up again, from the caches.
+        Incremental setups can fetch without blobs (partial_clone), check out only the configured sub folders
+        (sparse) and fetch depth commits of history, deepened until the merge base of the upstream branches.
+        """
+        if depth < 0:
+            raise ValueError(f"Invalid depth: {depth}, expected 0 (full history) or more")
+        if (partial_clone or sparse or depth) and not incremental:
+            raise ValueError("partial_clone, sparse and depth fetch into the repository caches, "
+                             "they require incremental")
+
+        working_dir = config.working_dir.resolve()
+        if not incremental:
+            print(f"Cleaning directory: {working_dir}")
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+            os.makedirs(working_dir, exist_ok=True)
+
+            # # step 1: setup 3 way merge for all projects
+            # SetupThreeWayMerge may work in the current directory, so every project runs in a process of its own
+            run_projects(config.projects, partial(Setup.setup_project, working_dir), workers,
+                         cwd=lambda project: working_dir)
+            return
 
         os.makedirs(working_dir, exist_ok=True)
+        cache = RepositoryCache((cache_dir or working_dir / ".cache").resolve())
+        options = {'partial_clone': partial_clone, 'sparse': sparse, 'depth': depth}
+        state_path = working_dir / SETUP_STATE_FILE_NAME
+        state = Setup.read_state(state_path)
+        errors = []
+
+        # fetches and snapshots only run git commands with explicit directories, they can share a process
+        fetched, fetch_errors = Setup.fetch_repositories(cache, Setup.plan_fetches(working_dir, config.projects),
+                                                         options, workers)
+        errors.extend(fetch_errors)
+        try:
+            prepared = run_projects(config.projects, lambda project: Setup.prepare_project(
+                working_dir, project, cache, options, state.get(project.key), fetched), workers)
+        except ProjectsFailedError as e:
+            prepared = e.results
+            errors.append(str(e))
+
+        repo_paths = {key: project['repo_paths'] for key, project in prepared.items() if project['repo_paths']}
+        try:
+            set_up = run_projects([project for project in config.projects if project.key in repo_paths],
+                                  partial(Setup.setup_project_from, working_dir, repo_paths), workers,
+                                  cwd=lambda project: working_dir)
+        except ProjectsFailedError as e:
+            set_up = e.results
+            errors.append(str(e))
+        finally:
+            shutil.rmtree(working_dir / SNAPSHOTS_DIR_NAME, ignore_errors=True)
+
+        for key, project in prepared.items():
+            if key in repo_paths and key not in set_up:
+                # set up from scratch next time
+                state.pop(key, None)
+                continue
+            if key in set_up:
+                project['stats']['seconds'] += set_up[key]
+                project['state']['checkouts_revision'] = Setup.checkouts_revision(working_dir / f"__{key}")
+            state[key] = project['state']
+        Setup.write_state(state_path, state)
+        Setup.report({url: repository['stats'] for url, repository in fetched.items()},
+                     {key: project['stats'] for key, project in prepared.items()})
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+    @classmethod
+    def setup_project(cls, working_dir: Path, project: ProjectConfig,
+                      repo_paths: Optional[Dict[str, str]] = None) -> None:
+        """
+        Sets up the three way merge of the project, from the repositories of repo_paths by role
+        (base, local and remote) when given, otherwise from the configured ones.
+        """
+        base_dir = (working_dir / f"__{project.key}")
+        if repo_paths is None:
+            upstream_path = Setup.resolve_repo_path(working_dir, project.upstream_project_git_path)
+            local_path = Setup.resolve_repo_path(working_dir, project.local_project_git_path)
+            repo_paths = {'base': upstream_path, 'local': local_path, 'remote': upstream_path}
+
+        repo_infos = MergeRepoInfos(
+            base=RepoInfo(
+                repo_path=repo_paths['base'],
+                branch=project.upstream_project_base_branch,
+                sub_path=project.upstream_project_sub_folder,
+            ),
+            local=RepoInfo(
+                repo_path=repo_paths['local'],
+                branch=project.local_project_branch,
+                sub_path=project.local_project_sub_folder,
+            ),
+            remote=RepoInfo(
+                repo_path=repo_paths['remote'],
+                branch=project.upstream_project_head_branch,
+                sub_path=project.upstream_project_sub_folder,
+            ),
+        )
+        SetupThreeWayMerge().execute(output_dir=base_dir, repo_infos=repo_infos)
+
+    @classmethod
+    def setup_project_from(cls, working_dir: Path, repo_paths: Dict[str, Dict[str, str]],
+                           project: ProjectConfig) -> float:
+        """
+        Sets up the project from its repositories in repo_paths by project key, returning the time taken.
+        """
+        start = time.perf_counter()
+        Setup.setup_project(working_dir, project, repo_paths[project.key])
+        return time.perf_counter() - start
+
+    @classmethod
+    def plan_fetches(cls, working_dir: Path, projects: List[ProjectConfig]) -> Dict[str, dict]:
+        """
+        The branches to fetch from every repository url over all projects, and the pairs of branches
+        whose merge base a shallow fetch has to reach, so that projects sharing a url fetch it once.
+        """
+        plans = {}
+        for project in projects:
+            upstream_url = Setup.resolve_repo_path(working_dir, project.upstream_project_git_path)
+            local_url = Setup.resolve_repo_path(working_dir, project.local_project_git_path)
+            upstream_plan = plans.setdefault(upstream_url, {'branches': set(), 'merge_bases': set()})
+            upstream_plan['branches'].update([project.upstream_project_base_branch,
+                                              project.upstream_project_head_branch])
+            upstream_plan['merge_bases'].add((project.upstream_project_base_branch,
+                                              project.upstream_project_head_branch))
+            plans.setdefault(local_url, {'branches': set(), 'merge_bases': set()})['branches'].add(
+                project.local_project_branch)
+        return plans
+
+    @classmethod
+    def fetch_repositories(cls, cache: RepositoryCache, plans: Dict[str, dict], options: dict,
+                           workers: int) -> Tuple[Dict[str, dict], List[str]]:
+        """
+        Fetches the planned branches of every repository url, on up to workers threads. Returns the commits
+        and stats of the fetched urls by url, and the errors of those that failed.
+        """
+        def fetch(url: str):
+            try:
+                return Setup.fetch_repository(cache, url, plans[url], options)
+            except Exception as e:
+                log(f"Failed to fetch {url}: {e!r}")
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(plans)))) as executor:
+            outcomes = dict(zip(plans, executor.map(fetch, plans)))
+
+        fetched = {url: outcome for url, outcome in outcomes.items() if not isinstance(outcome, Exception)}
+        failures = [f"{url}: {type(outcome).__name__}: {outcome}"
+                    for url, outcome in outcomes.items() if isinstance(outcome, Exception)]
+        if failures:
+            return fetched, [f"{len(failures)} of {len(plans)} repositories failed to fetch:\n" + "\n".join(failures)]
+        return fetched, []
+
+    @classmethod
+    def fetch_repository(cls, cache: RepositoryCache, url: str, plan: dict, options: dict) -> dict:
+        """
+        Fetches the planned branches of url into its cache, deepening a shallow fetch until the merge base
+        of every planned pair of branches. Returns the commit of every branch and the stats.
+        """
+        start = time.perf_counter()
+        stats = {'bytes_fetched': 0}
+        commits = cache.fetch(url, sorted(plan['branches']), options['depth'], options['partial_clone'], stats)
+        if options['depth']:
+            for branch, other_branch in sorted(plan['merge_bases']):
+                cache.reach_merge_base(url, branch, other_branch, options['depth'], stats)
+        stats['seconds'] = time.perf_counter() - start
+        log(f"Fetched {Setup.format_bytes(stats['bytes_fetched'])} from {url} in {stats['seconds']:.2f}s")
+        return {'commits': commits, 'stats': stats}
+
+    @classmethod
+    def prepare_project(cls, working_dir: Path, project: ProjectConfig, cache: RepositoryCache,
+                        options: dict, previous_state: Optional[dict], fetched: Dict[str, dict]) -> dict:
+        """
+        Unless the previous setup was from the same configuration, options and commits, with the branches
+        fetched into the caches, clears the project and gives the repositories to set it up from again:
+        the caches, or snapshots of them for sparse setups and partial caches.
+        Returns the new state, the repository paths by role (None to skip the project) and the stats.
+        """
+        start = time.perf_counter()
+        stats = {'bytes_fetched': 0, 'skipped': False}
+        upstream_url = Setup.resolve_repo_path(working_dir, project.upstream_project_git_path)
+        local_url = Setup.resolve_repo_path(working_dir, project.local_project_git_path)
+        for url in (upstream_url, local_url):
+            if url not in fetched:
+                raise RuntimeError(f"Fetching {url} failed")
+        upstream_commits = fetched[upstream_url]['commits']
+        local_commits = fetched[local_url]['commits']
+
+        project_state = {
+            'upstream': upstream_url,
+            'upstream_sub_folder': project.upstream_project_sub_folder,
+            'base_commit': upstream_commits[project.upstream_project_base_branch],
+            'remote_commit': upstream_commits[project.upstream_project_head_branch],
+            'local': local_url,
+            'local_sub_folder': project.local_project_sub_folder,
+            'local_commit': local_commits[project.local_project_branch],
+            **options,
+        }
+
+        repo_paths = None
+        base_dir = (working_dir / f"__{project.key}")
+        previous_state = dict(previous_state or {})
+        previous_revision = previous_state.pop('checkouts_revision', None)
+        # transformations and merges commit into the merge directory and any of the base, local and remote
+        # checkouts can be edited by hand: a project with a changed checkout is set up again
+        if (project_state == previous_state and previous_revision
+                and Setup.checkouts_revision(base_dir) == previous_revision):
+            project_state['checkouts_revision'] = previous_revision
+            log("Unchanged since the last setup, skipping")
+            stats['skipped'] = True
+        else:
+            shutil.rmtree(base_dir, ignore_errors=True)
+            if options['sparse'] or cache.is_partial(upstream_url) or cache.is_partial(local_url):
+                repo_paths = Setup.materialize_snapshots(working_dir, project, cache, upstream_url, local_url,
+                                                         options['sparse'], stats)
+            else:
+                repo_paths = {
+                    'base': str(cache.path_for(upstream_url)),
+                    'local': str(cache.path_for(local_url)),
+                    'remote': str(cache.path_for(upstream_url)),
+                }
+
+        stats['seconds'] = time.perf_counter() - start
+        return {'state': project_state, 'repo_paths': repo_paths, 'stats': stats}
+
+    @classmethod
+    def materialize_snapshots(cls, working_dir: Path, project: ProjectConfig, cache: RepositoryCache,
+                              upstream_url: str, local_url: str, sparse: bool, stats: dict) -> Dict[str, str]:
+        snapshot_dir = working_dir / SNAPSHOTS_DIR_NAME / project.key
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.makedirs(snapshot_dir)
+        roles = {
+            'base': (upstream_url, project.upstream_project_base_branch, project.upstream_project_sub_folder),
+            'local': (local_url, project.local_project_branch, project.local_project_sub_folder),
+            'remote': (upstream_url, project.upstream_project_head_branch, project.upstream_project_sub_folder),
+        }
+        return {
+            role: str(cache.materialize(url, branch, sub_folder if sparse else "", snapshot_dir / role, stats))
+            for role, (url, branch, sub_folder) in roles.items()
+        }
+
+    @classmethod
+    def checkouts_revision(cls, base_dir: Path) -> Optional[str]:
+        """
+        A digest of every checkout of the project under base_dir (base, local, remote and merge_dir):
+        the head, refs and status of those that are repositories, the paths, sizes and modification times
+        of the files of the others. None when base_dir is missing.
+        """
+        if not os.path.isdir(base_dir):
+            return None
+
+        digest = hashlib.sha1()
+        for entry in sorted(os.scandir(base_dir), key=lambda entry: entry.name):
+            digest.update(f"{entry.name}\0".encode('utf-8'))
+            if not entry.is_dir(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                digest.update(f"{stat.st_size} {stat.st_mtime_ns}\0".encode('utf-8'))
+                continue
+            revision = Setup.repository_revision(Path(entry.path))
+            digest.update((revision or Setup.tree_revision(Path(entry.path))).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def repository_revision(cls, repo_dir: Path) -> Optional[str]:
+        """
+        A digest of the head, refs and status of the repository, None when repo_dir is not the top of one.
+        """
+        try:
+            if run_command('git rev-parse --show-cdup', cwd=repo_dir, quiet=True).strip():
+                # inside the repository of a parent directory, not one of its own
+                return None
+            revision = ''.join(run_command(command, cwd=repo_dir, quiet=True) for command in (
+                'git rev-parse HEAD',
+                'git symbolic-ref --quiet HEAD || true',
+                'git for-each-ref --format="%(refname) %(objectname)"',
+                'git status --porcelain --untracked-files=all',
+            ))
+        except RuntimeError:
+            return None
+        return hashlib.sha1(revision.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def tree_revision(cls, directory: Path) -> str:
+        """
+        A digest of the relative paths, sizes and modification times of the files under directory.
+        """
+        digest = hashlib.sha1()
+        for current_dir, dir_names, file_names in os.walk(directory):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(current_dir, file_name)
+                stat = os.lstat(file_path)
+                digest.update(f"{os.path.relpath(file_path, directory)}\0{stat.st_size} {stat.st_mtime_ns}\0"
+                              .encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def report(cls, repository_stats: Dict[str, dict], project_stats: Dict[str, dict]) -> None:
+        """
+        Prints what every repository fetched and, per project, the setup time and the blobs fetched
+        lazily for its snapshots.
+        """
+        if repository_stats:
+            print("Fetch per repository:")
+            for url, stats in sorted(repository_stats.items()):
+                print(f"  {url}: fetched {Setup.format_bytes(stats['bytes_fetched'])} in {stats['seconds']:.2f}s")
+        if project_stats:
+            print("Setup per project:")
+            for key, stats in sorted(project_stats.items()):
+                status = "unchanged" if stats['skipped'] else "set up"
+                print(f"  {key}: {status} in {stats['seconds']:.2f}s, "
+                      f"fetched {Setup.format_bytes(stats['bytes_fetched'])} for snapshots")
+
+        total_bytes = sum(stats['bytes_fetched'] for stats in [*repository_stats.values(), *project_stats.values()])
+        print(f"Total fetched: {Setup.format_bytes(total_bytes)}")
+
+    @classmethod
+    def format_bytes(cls, size: int) -> str:
+        return f"{size / (1024 * 1024):.1f} MiB"
+
+    @classmethod
+    def read_state(cls, state_path: Path) -> dict:
+        if not os.path.exists(state_path):
+            return {}
+        with open(state_path, encoding='utf-8') as file:
+            return json.load(file)
+
+    @classmethod
+    def write_state(cls, state_path: Path, state: dict) -> None:
+        temp_path = state_path.with_name(state_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+        os.replace(temp_path, state_path)
 
-        # # step 1: setup 3 way merge for all projects
-        for project in config.projects:
-            os.chdir(working_dir)
-            base_dir = (working_dir / f"__{project.key}")
-            repo_infos = MergeRepoInfos(
-                base=RepoInfo(
-                    repo_path=project.upstream_project_git_path,
-                    branch=project.upstream_project_base_branch,
-                    sub_path=project.upstream_project_sub_folder,
-                ),
-                local=RepoInfo(
-                    repo_path=project.local_project_git_path,
-                    branch=project.local_project_branch,
-                    sub_path=project.local_project_sub_folder,
-                ),
-                remote=RepoInfo(
-                    repo_path=project.upstream_project_git_path,
-                    branch=project.upstream_project_head_branch,
-                    sub_path=project.upstream_project_sub_folder,
-                ),
-            )
-            SetupThreeWayMerge().execute(output_dir=base_dir, repo_infos=repo_infos)
+    @classmethod
+    def resolve_repo_path(cls, working_dir: Path, repo_path: str) -> str:
+        """
+        Relative local repository paths are relative to the working directory, as they were when
+        setup changed into it; remote urls are left as they are.
+        """
+        if '://' in repo_path or SCP_LIKE_REMOTE_PATTERN.match(repo_path) or os.path.isabs(repo_path):
+            return repo_path
+        return str((working_dir / repo_path).resolve())
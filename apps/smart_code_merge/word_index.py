@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+WORD_INDEX_VERSION = 1
+# A NUL byte in the head of a file marks it as binary, as git does
+BINARY_CHECK_BYTES = 8192
+SKIPPED_DIRECTORIES = {'.git'}
+
+# The words pattern of a pool worker, compiled once per process by init_worker
+_words_pattern: Optional[re.Pattern] = None
+
+
+def init_worker(words_regex: str) -> None:
+    global _words_pattern
+    _words_pattern = re.compile(words_regex)
+
+
+def scan_file(file_path: str) -> Optional[Dict[str, int]]:
+    """
+    Counts the words of a file, or returns None for a binary file.
+    """
+    with open(file_path, 'rb') as file:
+        content = file.read()
+    if b'\0' in content[:BINARY_CHECK_BYTES]:
+        return None
+    return dict(Counter(match.group(0) for match in _words_pattern.finditer(content.decode('utf-8', 'ignore'))))
+
+
+class WordIndex:
+    """
+    On-disk index of the words rename_words_regex finds in the project trees: for every file its
+    modification time, size and word counts, and for every word its total count and the files it is in.
+    Updating the index only scans the files added or changed since, on a process pool, and drops the
+    files that are gone; changing the regex starts a new index.
+    """
+
+    def __init__(self, index_path: Path, words_regex: str, root_dir: Path):
+        self.index_path = index_path
+        self.words_regex = words_regex
+        self.root_dir = root_dir
+        self.files: Dict[str, dict] = {}
+        self.words: Dict[str, dict] = {}
+
+    def load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, encoding='utf-8') as file:
+            index = json.load(file)
+        if index.get('version') == WORD_INDEX_VERSION and index.get('words_regex') == self.words_regex:
+            self.files = index['files']
+            self.words = index['words']
+
+    def save(self) -> None:
+        index = {
+            'version': WORD_INDEX_VERSION,
+            'words_regex': self.words_regex,
+            'files': self.files,
+            'words': self.words,
+        }
+        temp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(index, file, ensure_ascii=False, sort_keys=True)
+        os.replace(temp_path, self.index_path)
+
+    def update(self, directories: List[Path], workers: int = 1) -> dict:
+        """
+        Brings the index up to date with the files under directories and returns counters about the scan.
+        """
+        start = time.perf_counter()
+        stats = {'files': 0, 'files_scanned': 0, 'files_unchanged': 0, 'files_binary': 0, 'bytes_scanned': 0}
+        files = {}
+        changed = []
+        for file_path in WordIndex.walk_files(directories):
+            key = os.path.relpath(file_path, self.root_dir)
+            stat = os.stat(file_path)
+            entry = self.files.get(key)
+            stats['files'] += 1
+            if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                files[key] = entry
+                stats['files_unchanged'] += 1
+            else:
+                files[key] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'binary': False, 'words': {}}
+                changed.append(key)
+                stats['bytes_scanned'] += stat.st_size
+
+        paths = [os.path.join(self.root_dir, key) for key in changed]
+        for key, words in zip(changed, self.scan_files(paths, workers)):
+            stats['files_scanned'] += 1
+            if words is None:
+                files[key]['binary'] = True
+                stats['files_binary'] += 1
+            else:
+                files[key]['words'] = words
+
+        self.files = files
+        self.words = WordIndex.aggregate(files)
+        stats['words'] = len(self.words)
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    def scan_files(self, paths: List[str], workers: int):
+        if workers <= 1 or len(paths) <= 1:
+            init_worker(self.words_regex)
+            return map(scan_file, paths)
+
+        chunk_size = max(1, min(64, len(paths) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(self.words_regex,)) as executor:
+            return list(executor.map(scan_file, paths, chunksize=chunk_size))
+
+    @classmethod
+    def walk_files(cls, directories: List[Path]):
+        for directory in directories:
+            for dir_path, dir_names, file_names in os.walk(directory):
+                dir_names[:] = sorted(name for name in dir_names if name not in SKIPPED_DIRECTORIES)
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(dir_path, file_name)
+                    if os.path.isfile(file_path) and not os.path.islink(file_path):
+                        yield file_path
+
+    @classmethod
+    def aggregate(cls, files: Dict[str, dict]) -> Dict[str, dict]:
+        words = {}
+        for key, entry in files.items():
+            for word, count in entry['words'].items():
+                word_entry = words.setdefault(word, {'count': 0, 'files': []})
+                word_entry['count'] += count
+                word_entry['files'].append(key)
+        return words
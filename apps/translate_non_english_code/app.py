@@ -4,6 +4,8 @@ from translate_non_english_code.apply_translation import ApplyTranslation
 from translate_non_english_code.prepare_translation import PrepareForTranslation
 from translate_non_english_code.translate import Translate
 from translate_non_english_code.build_translation_cache import BuildTranslationCache
+from translate_non_english_code.convert_map import ConvertMap
+from translate_non_english_code.compile_translation_cache import CompileTranslationCache
 
 
 def main():
@@ -12,6 +14,8 @@ def main():
     app.register_flow(PrepareForTranslation())
     app.register_flow(Translate())
     app.register_flow(BuildTranslationCache())
+    app.register_flow(ConvertMap())
+    app.register_flow(CompileTranslationCache())
 
     app.main()
 
@@ -1,63 +1,239 @@
+import itertools
+import os
 import shutil
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any
-
-import yaml
+from typing import Any, Optional
 
 from kwiq.core.flow import Flow
+from translate_non_english_code.instrumentation import start_instrumentation
+from translate_non_english_code.map_io import read_map
+from translate_non_english_code.translation_units import resolve_units
+from translate_non_english_code.utils import decorate_block, split_block_decoration
 
 
 # Applies translation to the target files as per the map
 class ApplyTranslation(Flow):
     name: str = "apply-translation"
 
-    def fn(self, map_file_path: Path) -> Any:
+    def fn(self, map_file_path: Path, workers: int = 1, map_format: Optional[str] = None,
+           report_path: Optional[Path] = None, profile_path: Optional[Path] = None) -> Any:
         """
         Apply translations from the map to the respective files.
         """
-        with open(map_file_path, 'r', encoding='utf-8') as file:
-            translation_map = yaml.full_load(file)
+        instrumentation = start_instrumentation(self.name, report_path, profile_path)
+        translation_map = instrumentation.timed_iter(resolve_units(read_map(map_file_path, map_format)),
+                                                     'deserialization')
+
+        start = time.perf_counter()
+        for file_stats in ApplyTranslation.update_files(translation_map, workers):
+            instrumentation.merge(file_stats)
 
-        for file_entry in translation_map:
-            file_path = file_entry['file']
-            print(f"Applying translation for: {file_path}")
-            updates = file_entry['map']
-            ApplyTranslation.update_file(file_path, updates)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        files = instrumentation.counters['files']
+        lines_changed = instrumentation.counters['lines_changed']
+        print(f"Applied translations to {files} files, {lines_changed} lines changed in {elapsed:.2f}s "
+              f"({files / elapsed:,.0f} files/s, {lines_changed / elapsed:,.0f} lines/s)")
+        instrumentation.finish()
+
+    @classmethod
+    def update_files(cls, translation_map, workers=1):
+        """
+        Yield the stats of updating every file in the map, spreading the files across
+        a process pool when there is more than one worker.
+        """
+        if workers <= 1:
+            for file_entry in translation_map:
+                yield cls.update_file(file_entry['file'], file_entry['map'])
+            return
+
+        # Submit a bounded window of records at a time, so a streamed map is never held in memory as a whole
+        window_size = workers * 16
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                window = list(itertools.islice(translation_map, window_size))
+                if not window:
+                    break
+                yield from executor.map(cls.update_file,
+                                        [file_entry['file'] for file_entry in window],
+                                        [file_entry['map'] for file_entry in window])
 
     @classmethod
     def update_file(cls, file_path, updates):
         """
         Update the file at the given path based on the provided updates.
+        Returns the stats of the update, among them the number of lines that changed.
         """
+        print(f"Applying translation for: {file_path}")
+        start = time.perf_counter()
+        line_replacements = cls.index_replacements(updates)
+        block_ends = cls.index_blocks(updates)
+        lines_changed = 0
+
+        # The temporary file lives next to the target, so the final rename is atomic on the same filesystem
+        directory, file_name = os.path.split(file_path)
         with (open(file_path, 'r', encoding='utf-8') as file,
-              tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file):
-            print(f"----> Writing applied translation to: {temp_file.name}")
+              tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', dir=directory or '.',
+                                          prefix=f'.{file_name}.', suffix='.tmp', delete=False) as temp_file):
+            try:
+                line_number = 0
+                block = None
+                block_end = 0
+                block_replacements = {}
+                for content in file:
+                    line_number += 1
 
-            line_number = 0
-            for content in file:
-                line_number += 1
+                    if block is None and line_number in block_ends:
+                        block = []
+                        block_replacements = {}
+                    if block is not None:
+                        # Buffer the lines of a multi-line block, a block starting on its last line included
+                        block.append(content)
+                        block_end = max(block_end, block_ends.get(line_number, 0))
+                        for original, translated in line_replacements.get(line_number, {}).items():
+                            block_replacements.setdefault(original, translated)
+                        if line_number < block_end:
+                            continue
 
-                for update in updates:
-                    positions = set(update['positions'])
-                    if positions is None or len(positions) == 0:
+                        content, block_lines_changed = cls.apply_block(block, block_replacements)
+                        lines_changed += block_lines_changed
+                        block = None
+                        temp_file.write(content)
                         continue
 
-                    if line_number not in positions:
-                        continue
+                    replacements = line_replacements.get(line_number)
+                    if replacements:
+                        updated_content = cls.apply_replacements(content, replacements)
+                        if updated_content != content:
+                            lines_changed += 1
+                            content = updated_content
+
+                    temp_file.write(content)
+
+                # A block that runs past the end of the file is applied to the lines there are
+                if block is not None:
+                    content, block_lines_changed = cls.apply_block(block, block_replacements)
+                    lines_changed += block_lines_changed
+                    temp_file.write(content)
+            except BaseException:
+                os.unlink(temp_file.name)
+                raise
+
+        stats = {
+            'files': 1,
+            'lines': line_number,
+            'lines_changed': lines_changed,
+            'bytes': os.path.getsize(temp_file.name),
+        }
+
+        if lines_changed == 0:
+            # Leave unchanged files, and their mtimes, alone
+            os.unlink(temp_file.name)
+            stats['apply_seconds'] = time.perf_counter() - start
+            return stats
+
+        shutil.copymode(file_path, temp_file.name)
+        os.replace(temp_file.name, file_path)
+        print(f"----> Replaced {file_path} ({lines_changed} lines changed)")
+        stats['files_replaced'] = 1
+        stats['apply_seconds'] = time.perf_counter() - start
+        return stats
+
+    @classmethod
+    def index_replacements(cls, updates):
+        """
+        Build the line number -> {original: translated} index of the updates, once per file.
+        """
+        line_replacements = {}
+        for update in updates:
+            positions = update.get('positions')
+            if not positions:
+                continue
+
+            replacements = []
+            original_text = update['original_text']
+            translated_text = update.get('translated_text')
+            if translated_text is not None and update.get('line_count', 1) > 1:
+                # the translation of a block is of its text alone, every line gets its prefix back
+                translated_text = decorate_block(translated_text, split_block_decoration(original_text)[0])
+            # Identity replacements are skipped, so the chunks inside an untranslated text still apply
+            if original_text and translated_text is not None and original_text != translated_text:
+                replacements.append((original_text, translated_text))
+            for chunk in update.get('chunks') or []:
+                if chunk['original'] and chunk['original'] != chunk['translated']:
+                    replacements.append((chunk['original'], chunk['translated']))
+
+            if not replacements:
+                continue
+
+            for line_number in set(positions):
+                line_map = line_replacements.setdefault(line_number, {})
+                for original, translated in replacements:
+                    # The first update of a text wins, as it did with sequential str.replace
+                    line_map.setdefault(original, translated)
+
+        return line_replacements
+
+    @classmethod
+    def index_blocks(cls, updates):
+        """
+        Build the first line -> last line index of the updates that span several lines.
+        """
+        block_ends = {}
+        for update in updates:
+            line_count = update.get('line_count', 1)
+            if line_count <= 1:
+                continue
+
+            for line_number in set(update.get('positions') or []):
+                block_ends[line_number] = max(block_ends.get(line_number, 0), line_number + line_count - 1)
+
+        return block_ends
+
+    @classmethod
+    def apply_block(cls, block, replacements):
+        """
+        Apply the replacements of all the lines of a block to the block as a whole, so a text spanning
+        several lines is found. Returns the updated text and the number of lines changed.
+        """
+        content = ''.join(block)
+        updated_content = cls.apply_replacements(content, replacements) if replacements else content
+        if updated_content == content:
+            return content, 0
+        return updated_content, len(block)
+
+    @classmethod
+    def apply_replacements(cls, content, replacements):
+        """
+        Replace all the originals in one left-to-right pass; where they overlap the longest one wins.
+        """
+        if len(replacements) == 1:
+            (original, translated), = replacements.items()
+            return content.replace(original, translated)
 
-                    original_text = update['original_text']
-                    translated_text = update['translated_text']
+        # A line only has a handful of replacements, so finding each of them with str.find and
+        # sweeping the occurrences is far cheaper than compiling an alternation per line
+        occurrences = []
+        for original in replacements:
+            start = content.find(original)
+            while start != -1:
+                occurrences.append((start, -len(original), original))
+                start = content.find(original, start + 1)
 
-                    # Replace all the occurrence of the original text
-                    content = content.replace(original_text, translated_text)
-                    if 'chunks' in update and update['chunks']:
-                        for chunk in update['chunks']:
-                            original_chunk = chunk['original']
-                            translated_chunk = chunk['translated']
-                            content = content.replace(original_chunk, translated_chunk)
+        if not occurrences:
+            return content
 
-                print(content, file=temp_file, end='')
+        occurrences.sort()
+        parts = []
+        last_end = 0
+        for start, negative_length, original in occurrences:
+            if start < last_end:
+                continue
+            parts.append(content[last_end:start])
+            parts.append(replacements[original])
+            last_end = start - negative_length
 
-        shutil.move(temp_file.name, file_path)
-        print(f"----> Successfully moved {temp_file.name} to {file_path}")
+        parts.append(content[last_end:])
+        return ''.join(parts)
@@ -0,0 +1,290 @@
+import asyncio
+import random
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from translate_non_english_code.build_translation_cache import CREATE_TRANSLATIONS_TABLE_SQL, UPSERT_TRANSLATION_SQL
+from translate_non_english_code.translation_journal import TranslationJournal
+
+GOOGLE_TRANSLATE_URL = 'https://translation.googleapis.com/language/translate/v2'
+# Responses worth another attempt: throttling, timeouts and server errors
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class GoogleTranslateEndpoint:
+    """
+    Requests and responses of the Google Cloud Translation v2 REST API, one request per batch of texts.
+    Any object with the same request/parse methods can be plugged into AsyncBatchTranslator instead,
+    and the url can point at a local stub server speaking this format.
+    """
+
+    def __init__(self, url: str = GOOGLE_TRANSLATE_URL, api_key: Optional[str] = None, target_language: str = 'en'):
+        self.url = url
+        self.api_key = api_key
+        self.target_language = target_language
+
+    def request(self, texts: List[str]) -> dict:
+        """
+        Keyword arguments of the aiohttp request translating the texts.
+        """
+        return {
+            'method': 'POST',
+            'url': self.url,
+            'params': {'key': self.api_key} if self.api_key else None,
+            'json': {'q': texts, 'target': self.target_language, 'format': 'text'},
+        }
+
+    def parse(self, payload: dict, texts: List[str]) -> List[Optional[str]]:
+        """
+        The translations in a response, in the order of the texts.
+        """
+        return [translation.get('translatedText') for translation in payload['data']['translations']]
+
+
+class TokenBucket:
+    """
+    Lets rate requests per second through on average, with bursts of up to capacity requests.
+    The rate halves when the server throttles, at most once a second, and climbs back towards
+    max_rate by a twentieth of it after every rate successes, so it settles just below the quota.
+    """
+
+    def __init__(self, max_rate: float, capacity: Optional[float] = None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.capacity = capacity or max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._successes = 0
+        self._last_throttle = 0.0
+        self._lock = asyncio.Lock()
+
+    def on_success(self) -> None:
+        self._successes += 1
+        if self._successes >= self.rate:
+            self._successes = 0
+            self.rate = min(self.rate + max(1.0, self.max_rate / 20), self.max_rate)
+
+    def on_throttled(self) -> None:
+        now = time.monotonic()
+        if now - self._last_throttle < 1.0:
+            return
+
+        self._last_throttle = now
+        self._successes = 0
+        self.rate = max(self.rate / 2, self.max_rate / 100)
+        self.tokens = min(self.tokens, 1.0)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    Limit on the requests in flight, adjusted the way TCP adjusts its window: one more after a full
+    window of successes below the target latency, half as many after a throttled, failed or slow
+    request. Decreases are at most one per target latency, so a burst of 429s halves the limit once.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, target_latency: float = 2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if latency > self.target_latency:
+            self.decrease()
+            return
+
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            self.limit = min(self.limit + 1, self.maximum)
+
+    def decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.target_latency:
+            return
+
+        self._last_decrease = now
+        self._successes = 0
+        self.limit = max(self.limit // 2, self.minimum)
+
+
+class AsyncBatchTranslator:
+    """
+    Translates batches of texts with one HTTP request per batch, on an asyncio event loop with a pooled
+    session. Requests go through an adaptive token bucket and concurrency limit, and throttled or
+    failed requests are retried with jittered exponential backoff. Has the translate/close interface
+    and calls counter of BatchTranslator, so translate_texts can use either. Completed batches are
+    upserted into the SQLite translation cache, like the sync translator caches every result; with a
+    journal its checkpoints do that instead.
+    """
+
+    def __init__(self, endpoint, rate_limit: float = 10.0, concurrency: int = 4, max_concurrency: int = 32,
+                 target_latency: float = 2.0, max_retries: int = 5, backoff_base: float = 0.5,
+                 backoff_cap: float = 30.0, timeout: float = 60.0, journal: Optional[TranslationJournal] = None,
+                 translation_cache_path: Optional[Path] = None):
+        self.endpoint = endpoint
+        self.rate_limit = rate_limit
+        self.concurrency = max(1, concurrency)
+        self.max_concurrency = max(self.concurrency, max_concurrency)
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.journal = journal
+        self.translation_cache_path = translation_cache_path
+        self._connection = None
+        self.calls = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.final_concurrency = self.concurrency
+        self.final_rate = rate_limit
+
+    def translate(self, batches: List[List[str]]) -> Dict[str, Optional[str]]:
+        if not batches:
+            return {}
+
+        start = time.perf_counter()
+        if self.translation_cache_path and not self.journal and not self._connection:
+            self._connection = sqlite3.connect(self.translation_cache_path)
+            self._connection.execute(CREATE_TRANSLATIONS_TABLE_SQL)
+            self._connection.commit()
+        translations = asyncio.run(self.translate_batches(batches))
+        print(f"Async translation: {self.requests} requests, {self.retries} retries, {self.throttled} throttled, "
+              f"concurrency ended at {self.final_concurrency} and rate at {self.final_rate:.1f}/s, "
+              f"{time.perf_counter() - start:.2f}s")
+        return translations
+
+    async def translate_batches(self, batches: List[List[str]]) -> Dict[str, Optional[str]]:
+        bucket = TokenBucket(self.rate_limit)
+        limiter = AdaptiveConcurrency(self.concurrency, maximum=self.max_concurrency,
+                                      target_latency=self.target_latency)
+        pending = asyncio.Queue()
+        for batch in batches:
+            pending.put_nowait(batch)
+
+        translations = {}
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            async def worker():
+                while not pending.empty():
+                    batch = pending.get_nowait()
+                    translations.update(await self.translate_batch(session, bucket, limiter, batch))
+
+            # The workers only bound the batches in progress; the limiter decides how many are in flight
+            workers = [asyncio.create_task(worker()) for _ in range(min(self.max_concurrency, len(batches)))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+        self.final_concurrency = limiter.limit
+        self.final_rate = bucket.rate
+        return translations
+
+    async def translate_batch(self, session, bucket: TokenBucket, limiter: AdaptiveConcurrency,
+                              batch: List[str]) -> Dict[str, Optional[str]]:
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            retry_after = None
+            async with limiter:
+                start = time.monotonic()
+                try:
+                    async with session.request(**self.endpoint.request(batch)) as response:
+                        self.requests += 1
+                        if response.status not in RETRY_STATUSES:
+                            response.raise_for_status()
+                            payload = await response.json(content_type=None)
+                            limiter.on_success(time.monotonic() - start)
+                            bucket.on_success()
+                            return self.completed(batch, self.endpoint.parse(payload, batch))
+
+                        if response.status == 429:
+                            self.throttled += 1
+                            bucket.on_throttled()
+                        retry_after = response.headers.get('Retry-After')
+                        error = f"HTTP {response.status}"
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    error = repr(e)
+                limiter.decrease()
+
+            if attempt == self.max_retries:
+                raise RuntimeError(f"Giving up on a batch of {len(batch)} texts after {attempt + 1} attempts: {error}")
+
+            self.retries += 1
+            await asyncio.sleep(self.backoff(attempt, retry_after))
+
+    def completed(self, batch: List[str], translated_texts: List[Optional[str]]) -> Dict[str, Optional[str]]:
+        translations = dict(zip(batch, translated_texts))
+        self.calls += len(batch)
+        if self.journal:
+            for text, translated_text in translations.items():
+                if translated_text is not None:
+                    self.journal.record(text, translated_text)
+        elif self._connection:
+            # one short transaction per batch, on the event loop thread that owns the connection
+            with self._connection:
+                self._connection.executemany(UPSERT_TRANSLATION_SQL, [
+                    (text, translated_text) for text, translated_text in translations.items()
+                    if translated_text is not None])
+        return translations
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Full jitter: a random wait up to the exponential backoff, so throttled clients do not retry in lockstep.
+        A Retry-After in seconds from the server is the least to wait.
+        """
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'final_concurrency': self.final_concurrency,
+            'final_rate': self.final_rate,
+        }
+
+    def close(self) -> None:
+        # the session lives for one translate call; flush what was translated up to here
+        if self.journal:
+            self.journal.checkpoint()
+        if self._connection:
+            self._connection.close()
+            self._connection = None
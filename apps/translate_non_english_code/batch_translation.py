@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from translate_non_english_code.instrumentation import Instrumentation
+from translate_non_english_code.memory_cache import MemoryTranslationCache
+from translate_non_english_code.translation_units import record_entries
+
+# SQLite refuses statements with more host parameters than this (SQLITE_MAX_VARIABLE_NUMBER on old builds)
+SQLITE_LOOKUP_CHUNK = 900
+
+
+def collect_translation_texts(input_map) -> List[str]:
+    """
+    Unique translation inputs and chunks across the whole map, in order of first appearance.
+    """
+    texts = {}
+    for file_entry in input_map:
+        for input_entry in record_entries(file_entry):
+            if 'translation_input' in input_entry and input_entry['translation_input']:
+                texts[input_entry['translation_input']] = None
+                for chunk in input_entry.get('chunks') or []:
+                    texts[chunk] = None
+
+    return list(texts)
+
+
+def lookup_cached_translations(db_path: Optional[Path], texts: List[str]) -> Dict[str, str]:
+    """
+    Looks up all the texts in the translations table of the cache with a handful of IN queries.
+    """
+    if not db_path or not os.path.exists(db_path):
+        return {}
+
+    cached = {}
+    connection = sqlite3.connect(db_path)
+    try:
+        for start in range(0, len(texts), SQLITE_LOOKUP_CHUNK):
+            chunk = texts[start:start + SQLITE_LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT original_text, translated_text FROM translations WHERE original_text IN ({placeholders})',
+                chunk)
+            cached.update(rows)
+    except sqlite3.OperationalError as e:
+        # no translations table yet, every text is a miss
+        print(f"Skipping bulk cache lookup in {db_path}: {e}")
+    finally:
+        connection.close()
+
+    return cached
+
+
+def split_batches(texts: Iterable[str], batch_size: int, batch_chars: int) -> List[List[str]]:
+    """
+    Splits texts into batches of at most batch_size texts and batch_chars characters.
+    A single text longer than batch_chars gets a batch of its own.
+    """
+    batches = []
+    batch = []
+    batch_length = 0
+    for text in texts:
+        if batch and (len(batch) >= batch_size or batch_length + len(text) > batch_chars):
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+        batch.append(text)
+        batch_length += len(text)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+class BatchTranslator:
+    """
+    Translates batches of texts on a bounded thread pool. Every worker thread gets its own
+    translator from translator_factory, since translators hold connections that are not thread safe.
+    The translators translate one text per call (GoogleTranslate has no batch request), so a batch is
+    a unit of work for a thread, still one round trip per text; the saving over the one by one path is
+    the deduplication, the bulk cache lookups and the concurrency. AsyncBatchTranslator sends a whole
+    batch as one request.
+    """
+
+    def __init__(self, translator_factory: Callable[[], object], concurrency: int = 4):
+        self.translator_factory = translator_factory
+        self.concurrency = max(1, concurrency)
+        self.calls = 0
+        self._local = threading.local()
+        self._translators = []
+        self._lock = threading.Lock()
+
+    def _translator(self):
+        translator = getattr(self._local, 'translator', None)
+        if translator is None:
+            translator = self.translator_factory()
+            self._local.translator = translator
+            with self._lock:
+                self._translators.append(translator)
+        return translator
+
+    def translate_batch(self, batch: List[str]) -> Dict[str, Optional[str]]:
+        translator = self._translator()
+        # one execute per text, the batch only groups the texts handed to this thread
+        translations = {text: translator.execute(text=text) for text in batch}
+        with self._lock:
+            self.calls += len(batch)
+        return translations
+
+    def translate(self, batches: List[List[str]]) -> Dict[str, Optional[str]]:
+        translations = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for batch_translations in executor.map(self.translate_batch, batches):
+                translations.update(batch_translations)
+        return translations
+
+    def close(self):
+        for translator in self._translators:
+            translator.close()
+        self._translators = []
+
+
+def translate_texts(texts: List[str], translation_cache_path: Optional[Path], translator_factory,
+                    batch_size: int, batch_chars: int, concurrency: int,
+                    memory_cache: Optional[MemoryTranslationCache] = None,
+                    instrumentation: Optional[Instrumentation] = None,
+                    lookup_caches: Iterable = (), batch_translator=None) -> Dict[str, Optional[str]]:
+    """
+    Resolves every unique text, first from the caches in bulk and then in batches from the translator.
+    lookup_caches are read-only caches with a get(text) method, such as the compiled cache or the journal
+    of a resumed run, checked in order after the memory cache. The batches go to batch_translator when
+    given, which for AsyncBatchTranslator is one request per batch, else to a BatchTranslator running
+    translators from translator_factory, which still makes one call per text.
+    """
+    start = time.perf_counter()
+    translations = {}
+    if memory_cache:
+        for text in texts:
+            translated_text = memory_cache.get(text)
+            if translated_text is not None:
+                translations[text] = translated_text
+
+    for lookup_cache in lookup_caches:
+        for text in texts:
+            if text not in translations:
+                translated_text = lookup_cache.get(text)
+                if translated_text is not None:
+                    translations[text] = translated_text
+                    if memory_cache:
+                        memory_cache.put(text, translated_text)
+
+    uncached = [text for text in texts if text not in translations]
+    for text, translated_text in lookup_cached_translations(translation_cache_path, uncached).items():
+        translations[text] = translated_text
+        if memory_cache:
+            memory_cache.put(text, translated_text)
+
+    misses = [text for text in texts if text not in translations]
+    if instrumentation:
+        instrumentation.add_time('cache_lookup', time.perf_counter() - start)
+        instrumentation.count('unique_texts', len(texts))
+        instrumentation.count('cache_hits', len(texts) - len(misses))
+    batches = split_batches(misses, batch_size, batch_chars)
+
+    batch_translator = batch_translator or BatchTranslator(translator_factory, concurrency)
+    try:
+        for text, translated_text in batch_translator.translate(batches).items():
+            translations[text] = translated_text
+            if memory_cache and translated_text is not None:
+                memory_cache.put(text, translated_text)
+    finally:
+        batch_translator.close()
+
+    elapsed = time.perf_counter() - start
+    if instrumentation:
+        instrumentation.count('translator_calls', batch_translator.calls)
+    print(f"Translated {len(texts)} unique texts: {len(texts) - len(misses)} from cache, "
+          f"{batch_translator.calls} translator calls in {len(batches)} batches, {elapsed:.2f}s")
+    return translations
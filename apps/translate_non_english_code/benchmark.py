@@ -0,0 +1,544 @@
+import argparse
+import random
+import re
+import time
+
+from translate_non_english_code.utils import LANG_PATTERNS, PATTERN_CHECK_SEQUENCE, WHOLE_LINE_PATTERN, CODE_SCANNERS
+
+NON_ENGLISH_WORDS = ["这是一个测试", "中文注释", "你好，世界！", "数据库连接失败", "用户名（必填）"]
+ENGLISH_WORDS = ["value", "result", "config", "user", "connect", "retry", "timeout", "index"]
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name, baseline_time, optimized_time, items):
+    print(f"{name}: {items} items")
+    print(f"  baseline:  {baseline_time:.3f}s ({items / baseline_time:,.0f} items/s)")
+    print(f"  optimized: {optimized_time:.3f}s ({items / optimized_time:,.0f} items/s)")
+    print(f"  speedup:   {baseline_time / optimized_time:.1f}x")
+
+
+def random_text(rng, words=4):
+    return ' '.join(rng.choice(NON_ENGLISH_WORDS if rng.random() < 0.3 else ENGLISH_WORDS) for _ in range(words))
+
+
+# ---- scanner: LANG_PATTERNS scanning ----
+
+def synthetic_code_lines(rng, count, long_line_every=50):
+    templates = [
+        'value = compute({a})  # {t}\n',
+        'print("{t}", \'{t}\')\n',
+        'const label = `{t}`; // {t}\n',
+        'call("{t}", "{t}", "{t}");\n',
+        '    """{t}"""\n',
+        'plain code line without anything\n',
+    ]
+    lines = []
+    for i in range(count):
+        if long_line_every and i % long_line_every == 0:
+            lines.append(', '.join(f'"{random_text(rng, 2)}"' for _ in range(200)) + '\n')
+        else:
+            lines.append(rng.choice(templates).format(a=rng.randint(0, 100), t=random_text(rng)))
+    return lines
+
+
+def legacy_scan(content, patterns):
+    """The per-pattern re.search loop the scanner replaced."""
+    spans = []
+    for pattern_type in PATTERN_CHECK_SEQUENCE:
+        for pattern in patterns.get(pattern_type, []):
+            while True:
+                match = re.search(pattern, content, re.DOTALL)
+                if not match:
+                    break
+                spans.append(match.group(1))
+                content = content[:match.start()] + '' + content[match.end():]
+
+    spans.append(re.search(WHOLE_LINE_PATTERN, content, re.DOTALL).group(1))
+    return spans
+
+
+def benchmark_scanner(lines, file_ext):
+    patterns = LANG_PATTERNS[file_ext]
+    scanner = CODE_SCANNERS[file_ext]
+
+    def run_legacy():
+        return sum(len(legacy_scan(line, patterns)) for line in lines)
+
+    def run_scanner():
+        total = 0
+        for line in lines:
+            spans, remainder = scanner.scan(line)
+            total += len(spans) + 1
+        return total
+
+    baseline_time, baseline_spans = timed(run_legacy)
+    optimized_time, optimized_spans = timed(run_scanner)
+    report(f"scanner ({file_ext})", baseline_time, optimized_time, len(lines))
+    print(f"  spans:     baseline={baseline_spans} optimized={optimized_spans}")
+
+
+# ---- translate-batch: one by one vs batched translation ----
+
+class StubTranslator:
+    """Local stand-in for GoogleTranslate that counts calls and simulates a round trip."""
+    calls = 0
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def execute(self, text):
+        StubTranslator.calls += 1
+        time.sleep(self.latency)
+        return text.upper()
+
+    def close(self):
+        pass
+
+
+def synthetic_translation_map(rng, files, entries):
+    translation_map = []
+    for i in range(files):
+        file_map = []
+        for _ in range(entries):
+            text = random_text(rng, 3)
+            file_map.append({'original_text': text, 'translation_input': text, 'positions': [1],
+                             'chunks': [word for word in text.split() if word in NON_ENGLISH_WORDS]})
+        translation_map.append({'file': f'file_{i}.py', 'map': file_map})
+    return translation_map
+
+
+def benchmark_translate_batch(translation_map, latency, concurrency):
+    import copy
+    from translate_non_english_code.translate import Translate
+
+    class StubTranslate(Translate):
+        @classmethod
+        def create_translator(cls, translation_cache_path):
+            return StubTranslator(latency)
+
+    for name, run in [
+        ('one by one', lambda m: list(StubTranslate.translate_one_by_one(m, None))),
+        ('batched', lambda m: list(StubTranslate.translate_in_batches(m, None, 50, 5000, concurrency))),
+    ]:
+        StubTranslator.calls = 0
+        elapsed, output_map = timed(run, copy.deepcopy(translation_map), repeat=1)
+        print(f"{name}: {StubTranslator.calls} translator calls, {elapsed:.3f}s")
+
+
+# ---- resume: checkpointed translate run after a crash ----
+
+class FailingStubTranslator(StubTranslator):
+    """StubTranslator that fails once the shared call count reaches fail_at, like a crashed run."""
+
+    def __init__(self, fail_at):
+        super().__init__(latency=0)
+        self.fail_at = fail_at
+
+    def execute(self, text):
+        if StubTranslator.calls >= self.fail_at:
+            raise RuntimeError(f"injected failure after {StubTranslator.calls} calls")
+        return super().execute(text)
+
+
+def benchmark_resume(translation_map, crash_at, checkpoint_every):
+    import copy
+    import os
+    import tempfile
+    from translate_non_english_code.batch_translation import collect_translation_texts
+    from translate_non_english_code.translate import Translate
+    from translate_non_english_code.translation_journal import TranslationJournal
+
+    texts = len(collect_translation_texts(translation_map))
+    fail_at = int(texts * crash_at)
+
+    class FailingStubTranslate(Translate):
+        @classmethod
+        def create_translator(cls, translation_cache_path):
+            return FailingStubTranslator(fail_at)
+
+    class StubTranslate(Translate):
+        @classmethod
+        def create_translator(cls, translation_cache_path):
+            return StubTranslator(latency=0)
+
+    class KilledTranslationJournal(TranslationJournal):
+        """Journal of a killed process: nothing is written after the last interval checkpoint."""
+
+        def checkpoint(self):
+            pass
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        journal_path = os.path.join(temp_dir, 'journal.jsonl')
+
+        StubTranslator.calls = 0
+        journal = KilledTranslationJournal(journal_path, checkpoint_every)
+        try:
+            list(FailingStubTranslate.translate_one_by_one(copy.deepcopy(translation_map), None, journal=journal))
+        except RuntimeError as e:
+            print(f"resume: {texts} unique texts, first run killed: {e}")
+        journal.close()
+        journaled = len(TranslationJournal.load(journal_path))
+        first_run_calls = StubTranslator.calls
+
+        StubTranslator.calls = 0
+        journal = TranslationJournal(journal_path, checkpoint_every, resume=True)
+        list(StubTranslate.translate_one_by_one(copy.deepcopy(translation_map), None, journal=journal))
+        journal.close()
+
+    print(f"  first run: {first_run_calls} translator calls, {journaled} journaled")
+    print(f"  resumed:   {journal.resumed} translations from the journal, {StubTranslator.calls} translator calls")
+    print(f"  repeated:  {first_run_calls + StubTranslator.calls - texts} calls "
+          f"(checkpoint every {checkpoint_every})")
+
+
+# ---- clean-strings: translation cache normalizer ----
+
+def legacy_clean_strings(text):
+    """The uncompiled re.search pipeline clean_strings replaced."""
+    from translate_non_english_code.build_translation_cache import CLEAN_STRING_PATTERNS
+
+    for pattern in CLEAN_STRING_PATTERNS:
+        match = re.search(pattern, text, re.DOTALL)
+        if match:
+            text = match.group(1)
+
+    return text.strip()
+
+
+def synthetic_cache_strings(rng, count, unique):
+    decorations = ['-- {t}', '- {t}', ' * {t}', '12. {t}', "'{t}'", '"{t}"', '`{t}`', '/* {t} */',
+                   '# {t}', '/// {t}', '// {t}', '{t}', '  {t}\n', '-- "{t}"', '# 1: {t}']
+    pool = [rng.choice(decorations).format(t=random_text(rng, 5)) for _ in range(unique)]
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def benchmark_clean_strings(texts):
+    from translate_non_english_code.build_translation_cache import clean_strings
+
+    mismatches = [text for text in texts if clean_strings(text) != legacy_clean_strings(text)]
+    print(f"clean-strings equivalence: {len(texts) - len(mismatches)}/{len(texts)} identical")
+    for text in mismatches[:10]:
+        print(f"  mismatch: {text!r}: {legacy_clean_strings(text)!r} != {clean_strings(text)!r}")
+
+    def run_legacy():
+        return [legacy_clean_strings(text) for text in texts]
+
+    def run_optimized():
+        clean_strings.cache_clear()
+        return [clean_strings(text) for text in texts]
+
+    baseline_time, _ = timed(run_legacy)
+    optimized_time, _ = timed(run_optimized)
+    report("clean-strings", baseline_time, optimized_time, len(texts))
+    print(f"  memo:      {clean_strings.cache_info()}")
+
+
+# ---- apply: ApplyTranslation line replacements ----
+
+def synthetic_apply_input(rng, line_count, update_count):
+    texts = [f"{rng.choice(NON_ENGLISH_WORDS)}{i}" for i in range(update_count)]
+    lines = []
+    updates = [{'original_text': text, 'translated_text': f"translated {i}", 'positions': [],
+                'chunks': [{'original': text[:2], 'translated': 'chunk'}]} for i, text in enumerate(texts)]
+    for line_number in range(1, line_count + 1):
+        line_updates = rng.sample(range(update_count), rng.randint(0, 3))
+        for index in line_updates:
+            updates[index]['positions'].append(line_number)
+        lines.append('x = call(' + ', '.join(f'"{texts[index]}"' for index in line_updates) + ')  # code\n')
+    return lines, updates
+
+
+def legacy_apply(lines, updates):
+    """The per line, per update loop update_file replaced."""
+    output = []
+    for line_number, content in enumerate(lines, 1):
+        for update in updates:
+            positions = set(update['positions'])
+            if positions is None or len(positions) == 0:
+                continue
+            if line_number not in positions:
+                continue
+            content = content.replace(update['original_text'], update['translated_text'])
+            if 'chunks' in update and update['chunks']:
+                for chunk in update['chunks']:
+                    content = content.replace(chunk['original'], chunk['translated'])
+        output.append(content)
+    return output
+
+
+def benchmark_apply(lines, updates, baseline_lines):
+    from translate_non_english_code.apply_translation import ApplyTranslation
+
+    def run_optimized():
+        line_replacements = ApplyTranslation.index_replacements(updates)
+        output = []
+        for line_number, content in enumerate(lines, 1):
+            replacements = line_replacements.get(line_number)
+            output.append(ApplyTranslation.apply_replacements(content, replacements) if replacements else content)
+        return output
+
+    sample = lines[:baseline_lines]
+    baseline_time, baseline_output = timed(legacy_apply, sample, updates, repeat=1)
+    optimized_time, optimized_output = timed(run_optimized)
+    identical = sum(a == b for a, b in zip(baseline_output, optimized_output))
+    print(f"apply: {len(lines)} lines, {len(updates)} updates")
+    print(f"  baseline:  {baseline_time:.3f}s for {len(sample)} lines, "
+          f"~{baseline_time * len(lines) / len(sample):.1f}s extrapolated")
+    print(f"  optimized: {optimized_time:.3f}s for {len(lines)} lines")
+    print(f"  identical: {identical}/{len(sample)} sampled lines")
+
+
+# ---- yaml: map file load and dump backends ----
+
+def synthetic_yaml_map(rng, size_mb):
+    """A translation map whose YAML dump is roughly size_mb megabytes."""
+    translation_map = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        file_map = []
+        for _ in range(20):
+            text = random_text(rng, 6)
+            file_map.append({'original_text': text, 'translation_input': text, 'translated_text': text.upper(),
+                             'positions': [rng.randint(1, 5000) for _ in range(3)],
+                             'chunks': [{'original': word, 'translated': word.upper()}
+                                        for word in text.split() if word in NON_ENGLISH_WORDS]})
+            size += 220 + 3 * len(text.encode('utf-8'))
+        translation_map.append({'file': f'src/module_{len(translation_map)}/file.py', 'map': file_map})
+    return translation_map
+
+
+def benchmark_yaml(translation_map):
+    import yaml
+    from translate_non_english_code.map_io import YAML_BACKEND, YAML_DUMP_OPTIONS, YamlDumper, YamlLoader
+
+    print(f"yaml: fastest available backend is {YAML_BACKEND}")
+    dumped = yaml.dump(translation_map, Dumper=yaml.SafeDumper, **YAML_DUMP_OPTIONS)
+    print(f"  map size:  {len(dumped.encode('utf-8')) / (1024 * 1024):.1f}MB, {len(translation_map)} files")
+
+    pure_dump, _ = timed(lambda: yaml.dump(translation_map, Dumper=yaml.SafeDumper, **YAML_DUMP_OPTIONS), repeat=1)
+    fast_dump, _ = timed(lambda: yaml.dump(translation_map, Dumper=YamlDumper, **YAML_DUMP_OPTIONS), repeat=1)
+    pure_load, pure_map = timed(lambda: yaml.load(dumped, Loader=yaml.SafeLoader), repeat=1)
+    fast_load, fast_map = timed(lambda: yaml.load(dumped, Loader=YamlLoader), repeat=1)
+
+    print(f"  dump:      pure-python {pure_dump:.2f}s, {YAML_BACKEND} {fast_dump:.2f}s "
+          f"({pure_dump / fast_dump:.1f}x)")
+    print(f"  load:      pure-python {pure_load:.2f}s, {YAML_BACKEND} {fast_load:.2f}s "
+          f"({pure_load / fast_load:.1f}x)")
+    print(f"  same data: {pure_map == fast_map == translation_map}")
+
+
+# ---- cache-lookup: compiled cache vs SQLite ----
+
+def synthetic_cache_lookups(rng, entries, lookups, miss_rate):
+    """Translations for the cache, and lookups of which roughly miss_rate are not in it."""
+    translations = {f'{random_text(rng, 6)} #{i}': f'translation {i}' for i in range(entries)}
+    texts = list(translations)
+    queries = [f'{random_text(rng, 6)} missing' if rng.random() < miss_rate else rng.choice(texts)
+               for _ in range(lookups)]
+    return translations, queries
+
+
+def benchmark_cache_lookup(translations, queries):
+    import os
+    import sqlite3
+    import tempfile
+    from translate_non_english_code.build_translation_cache import CREATE_TRANSLATIONS_TABLE_SQL
+    from translate_non_english_code.compiled_cache import CompiledTranslationCache, compile_translation_cache
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'translations.db')
+        cache_path = os.path.join(temp_dir, 'translations.cache')
+
+        connection = sqlite3.connect(db_path)
+        connection.execute(CREATE_TRANSLATIONS_TABLE_SQL)
+        connection.executemany('INSERT INTO translations (original_text, translated_text) VALUES (?, ?)',
+                               translations.items())
+        connection.commit()
+
+        compile_time, _ = timed(compile_translation_cache, db_path, cache_path, repeat=1)
+        print(f"cache-lookup: {len(translations)} translations, compiled in {compile_time:.2f}s, "
+              f"{os.path.getsize(db_path) / (1024 * 1024):.1f}MB SQLite, "
+              f"{os.path.getsize(cache_path) / (1024 * 1024):.1f}MB compiled")
+
+        def run_sqlite():
+            results = []
+            for text in queries:
+                row = connection.execute('SELECT translated_text FROM translations WHERE original_text = ?',
+                                         (text,)).fetchone()
+                results.append(row[0] if row else None)
+            return results
+
+        with CompiledTranslationCache(cache_path) as compiled_cache:
+            def run_compiled():
+                return [compiled_cache.get(text) for text in queries]
+
+            baseline_time, baseline_results = timed(run_sqlite)
+            optimized_time, optimized_results = timed(run_compiled)
+
+        connection.close()
+
+    report('cache-lookup', baseline_time, optimized_time, len(queries))
+    print(f"  latency:   SQLite {baseline_time / len(queries) * 1e6:.2f}us, "
+          f"compiled {optimized_time / len(queries) * 1e6:.2f}us per lookup")
+    print(f"  identical: {baseline_results == optimized_results}")
+
+
+# ---- utils: text helpers run on every match ----
+
+def legacy_replace_full_width_chars(text):
+    """The per call dict and 23 str.replace passes replace_full_width_chars replaced, copied as they were."""
+    replacements = {
+        '，': ',',  # Full-width comma
+        '：': ':',  # Full-width colon
+        '；': ';',  # Full-width semicolon
+        '。': '.',  # Full-width period
+        '！': '!',  # Full-width exclamation mark
+        '？': '?',  # Full-width question mark
+        '（': '(',  # Full-width left parenthesis
+        '）': ')',  # Full-width right parenthesis
+        '【': '[',  # Full-width left square bracket
+        '】': ']',  # Full-width right square bracket
+        '《': '<',  # Full-width less than sign
+        '》': '>',  # Full-width greater than sign
+        '“': '"',  # Full-width double quote (left)
+        '”': '"',  # Full-width double quote (right)
+        '‘': "'",  # Full-width single quote (left)
+        '’': "'",  # Full-width single quote (right)
+        '－': '-',  # Full-width hyphen-minus
+        '—': '-',  # Full-width em dash
+        '–': '-',  # Full-width en dash
+        '、': ',',  # asian comma
+        '\u200B': '',  # non-breaking space
+        '\u03BC': '\u00B5',  # mu symbol
+        '\u00A0': ' ',  # Non-breaking space
+    }
+
+    for full_width, half_width in replacements.items():
+        text = text.replace(full_width, half_width)
+    return text
+
+
+def synthetic_texts(rng, count):
+    texts = []
+    for i in range(count):
+        if i % 2:
+            texts.append(random_text(rng, 6))
+        else:
+            texts.append(' '.join(rng.choice(ENGLISH_WORDS) for _ in range(6)))
+    return texts
+
+
+def benchmark_utils(texts, save_path, compare_path):
+    import json
+    from translate_non_english_code.utils import replace_full_width_chars, is_english_or_technical, \
+        find_non_english_chunks
+
+    mismatches = sum(replace_full_width_chars(text) != legacy_replace_full_width_chars(text) for text in texts)
+    print(f"utils: {len(texts)} texts, replace_full_width_chars mismatches against legacy: {mismatches}")
+
+    functions = {
+        'legacy_replace_full_width_chars': legacy_replace_full_width_chars,
+        'replace_full_width_chars': replace_full_width_chars,
+        'is_english_or_technical': is_english_or_technical,
+        'find_non_english_chunks': find_non_english_chunks,
+    }
+    results = {}
+    for name, function in functions.items():
+        elapsed, _ = timed(lambda: [function(text) for text in texts])
+        results[name] = elapsed / len(texts) * 1e9
+        print(f"  {name:32} {results[name]:10.0f} ns/call")
+
+    if compare_path:
+        with open(compare_path, 'r', encoding='utf-8') as file:
+            previous = json.load(file)
+        for name, ns_per_call in results.items():
+            if name in previous:
+                change = ns_per_call / previous[name] - 1
+                flag = '  REGRESSION' if change > 0.10 else ''
+                print(f"  {name:32} {change:+10.1%} vs {compare_path}{flag}")
+
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for translate-non-english-code.')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the synthetic corpus.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_scanner = subparsers.add_parser('scanner', help='LANG_PATTERNS scanning of code lines.')
+    parser_scanner.add_argument('--lines', type=int, default=200_000, help='Number of synthetic lines.')
+    parser_scanner.add_argument('--ext', type=str, default='.py', help='File extension whose patterns to use.')
+
+    parser_batch = subparsers.add_parser('translate-batch', help='One by one vs batched translation calls.')
+    parser_batch.add_argument('--files', type=int, default=200, help='Number of files in the synthetic map.')
+    parser_batch.add_argument('--entries', type=int, default=20, help='Number of entries per file.')
+    parser_batch.add_argument('--latency', type=float, default=0.002, help='Simulated seconds per call.')
+    parser_batch.add_argument('--concurrency', type=int, default=8, help='Batch translation concurrency.')
+
+    parser_clean = subparsers.add_parser('clean-strings', help='Translation cache string normalizer.')
+    parser_clean.add_argument('--strings', type=int, default=500_000, help='Number of strings to clean.')
+    parser_clean.add_argument('--unique', type=int, default=50_000, help='Number of distinct strings.')
+
+    parser_apply = subparsers.add_parser('apply', help='ApplyTranslation line replacements.')
+    parser_apply.add_argument('--lines', type=int, default=100_000, help='Number of lines in the file.')
+    parser_apply.add_argument('--updates', type=int, default=10_000, help='Number of map entries.')
+    parser_apply.add_argument('--baseline-lines', type=int, default=1_000,
+                              help='Lines run through the legacy loop, which is extrapolated to the whole file.')
+
+    parser_yaml = subparsers.add_parser('yaml', help='YAML map load and dump backends.')
+    parser_yaml.add_argument('--size-mb', type=int, default=50, help='Approximate size of the map, e.g. 500.')
+
+    parser_utils = subparsers.add_parser('utils', help='replace_full_width_chars, is_english_or_technical and '
+                                                        'find_non_english_chunks.')
+    parser_utils.add_argument('--texts', type=int, default=200_000, help='Number of synthetic texts.')
+    parser_utils.add_argument('--save', type=str, help='Write the ns/call results to this JSON file.')
+    parser_utils.add_argument('--compare', type=str, help='Compare against results saved with --save.')
+
+    parser_cache = subparsers.add_parser('cache-lookup', help='Compiled translation cache vs SQLite lookups.')
+    parser_cache.add_argument('--entries', type=int, default=200_000, help='Number of cached translations.')
+    parser_cache.add_argument('--lookups', type=int, default=100_000, help='Number of lookups.')
+    parser_cache.add_argument('--miss-rate', type=float, default=0.2, help='Share of lookups not in the cache.')
+
+    parser_resume = subparsers.add_parser('resume', help='Translator calls repeated when resuming a failed run.')
+    parser_resume.add_argument('--files', type=int, default=200, help='Number of files in the synthetic map.')
+    parser_resume.add_argument('--entries', type=int, default=20, help='Number of entries per file.')
+    parser_resume.add_argument('--crash-at', type=float, default=0.9, help='Share of the texts done at the crash.')
+    parser_resume.add_argument('--checkpoint-every', type=int, default=100, help='Translations per checkpoint.')
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    if args.command == 'scanner':
+        benchmark_scanner(synthetic_code_lines(rng, args.lines), args.ext)
+    elif args.command == 'translate-batch':
+        benchmark_translate_batch(synthetic_translation_map(rng, args.files, args.entries),
+                                  args.latency, args.concurrency)
+    elif args.command == 'clean-strings':
+        benchmark_clean_strings(synthetic_cache_strings(rng, args.strings, args.unique))
+    elif args.command == 'apply':
+        benchmark_apply(*synthetic_apply_input(rng, args.lines, args.updates), args.baseline_lines)
+    elif args.command == 'yaml':
+        benchmark_yaml(synthetic_yaml_map(rng, args.size_mb))
+    elif args.command == 'utils':
+        benchmark_utils(synthetic_texts(rng, args.texts), args.save, args.compare)
+    elif args.command == 'cache-lookup':
+        benchmark_cache_lookup(*synthetic_cache_lookups(rng, args.entries, args.lookups, args.miss_rate))
+    elif args.command == 'resume':
+        benchmark_resume(synthetic_translation_map(rng, args.files, args.entries), args.crash_at,
+                         args.checkpoint_every)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,15 @@
+import functools
+import itertools
 import re
+import sqlite3
+import time
 from pathlib import Path
+from typing import Optional
 
 from kwiq.core.flow import Flow
 from kwiq.iterator.json_iterator import JsonIterator
 from kwiq.db.sqlite import DB as SqliteDB
+from translate_non_english_code.instrumentation import Instrumentation, start_instrumentation
 
 CLEAN_STRING_PATTERNS = [
     r'^--[\s]*(.*)$',
@@ -18,39 +24,102 @@ CLEAN_STRING_PATTERNS = [
     r'^///[\s]*(.*)$',
     r'^//[\s]*(.*)$',
 ]
+# All the patterns are anchored at the start, so match() is the same as search() and fails faster
+CLEAN_STRING_REGEXES = [re.compile(pattern, re.DOTALL) for pattern in CLEAN_STRING_PATTERNS]
+CLEAN_STRING_CACHE_SIZE = 1 << 16
 
-
-class BuildTranslationCache(Flow):
-    name: str = "build-translation-cache"
-
-    def fn(self, translation_file: Path, db_path: Path) -> None:
-        """
-        Builds translation cache from json file
-        """
-        command = SqliteDB(db_path=db_path)
-        command.command(sql='''
+CREATE_TRANSLATIONS_TABLE_SQL = '''
             CREATE TABLE IF NOT EXISTS translations (
                 original_text TEXT NOT NULL,
                 translated_text TEXT NOT NULL,
                 PRIMARY KEY (original_text)
             )
-            ''')
+            '''
 
-        for data in JsonIterator(file_path=translation_file, json_path="[*]"):
-            original_text = clean_strings(data['original_text'])
-            translated_text = clean_strings(data['translated_text'])
-            command.command(sql='''
+UPSERT_TRANSLATION_SQL = '''
             INSERT INTO translations (original_text, translated_text)
             VALUES (?, ?)
             ON CONFLICT(original_text) DO UPDATE SET
             translated_text = excluded.translated_text
-            ''',
-                            parameters=(original_text, translated_text))
+            '''
+
+
+class BuildTranslationCache(Flow):
+    name: str = "build-translation-cache"
+
+    def fn(self, translation_file: Path, db_path: Path, bulk: bool = False, chunk_size: int = 10000,
+           report_path: Optional[Path] = None, profile_path: Optional[Path] = None) -> None:
+        """
+        Builds translation cache from json file
+        """
+        instrumentation = start_instrumentation(self.name, report_path, profile_path)
+        if bulk:
+            BuildTranslationCache.bulk_load(translation_file, db_path, chunk_size, instrumentation)
+            instrumentation.finish()
+            return
+
+        command = SqliteDB(db_path=db_path)
+        command.command(sql=CREATE_TRANSLATIONS_TABLE_SQL)
+
+        records = JsonIterator(file_path=translation_file, json_path="[*]")
+        for data in instrumentation.timed_iter(records, 'parse'):
+            with instrumentation.stage('normalization'):
+                original_text = clean_strings(data['original_text'])
+                translated_text = clean_strings(data['translated_text'])
+            with instrumentation.stage('insert'):
+                command.command(sql=UPSERT_TRANSLATION_SQL,
+                                parameters=(original_text, translated_text))
+            instrumentation.count('rows')
+
+        instrumentation.finish()
+
+    @classmethod
+    def bulk_load(cls, translation_file: Path, db_path: Path, chunk_size: int,
+                  instrumentation: Instrumentation) -> None:
+        """
+        Streams the records in chunks and loads every chunk with executemany in one transaction.
+        """
+        connection = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')
+            # A crash while loading leaves a cache that is simply rebuilt, so skip the fsyncs; synchronous
+            # only holds for this connection, later connections to the cache get their default back
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA temp_store = MEMORY')
+            connection.execute('PRAGMA cache_size = -262144')
+            connection.execute(CREATE_TRANSLATIONS_TABLE_SQL)
+
+            start = time.perf_counter()
+            total_rows = 0
+            records = iter(JsonIterator(file_path=translation_file, json_path="[*]"))
+            while True:
+                with instrumentation.stage('parse'):
+                    chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+
+                with instrumentation.stage('normalization'):
+                    rows = [(clean_strings(data['original_text']), clean_strings(data['translated_text']))
+                            for data in chunk]
+
+                with instrumentation.stage('insert'):
+                    connection.execute('BEGIN')
+                    connection.executemany(UPSERT_TRANSLATION_SQL, rows)
+                    connection.execute('COMMIT')
+
+                instrumentation.count('rows', len(rows))
+                total_rows += len(rows)
+                elapsed = time.perf_counter() - start
+                print(f"Loaded {total_rows} rows ({total_rows / elapsed:,.0f} rows/sec)")
+        finally:
+            connection.close()
 
 
+@functools.lru_cache(maxsize=CLEAN_STRING_CACHE_SIZE)
 def clean_strings(text: str) -> str:
-    for pattern in CLEAN_STRING_PATTERNS:
-        match = re.search(pattern, text, re.DOTALL)
+    # Translation dumps repeat the same strings a lot, hence the memo
+    for regex in CLEAN_STRING_REGEXES:
+        match = regex.match(text)
         if match:
             text = match.group(1)
 
@@ -0,0 +1,20 @@
+import time
+from pathlib import Path
+
+from kwiq.core.flow import Flow
+from translate_non_english_code.compiled_cache import compile_translation_cache
+
+
+# Compiles the SQLite translation cache into the memory-mapped format Translate reads
+class CompileTranslationCache(Flow):
+    name: str = "compile-translation-cache"
+
+    def fn(self, db_path: Path, output_path: Path) -> None:
+        """
+        Compile the translations table of the SQLite cache into a memory-mapped hash table file.
+        Run it again after build-translation-cache, a compiled cache is a snapshot of the table.
+        """
+        start = time.perf_counter()
+        translations = compile_translation_cache(db_path, output_path)
+        print(f"Compiled {translations} translations from {db_path} to {output_path} "
+              f"in {time.perf_counter() - start:.2f}s")
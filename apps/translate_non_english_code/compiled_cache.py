@@ -0,0 +1,162 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+# File layout: header, then a table of slots, then the records the slots point at
+#   header: magic, format version, number of slots (a power of two), number of records
+#   slot:   8 byte key hash, offset of the record (0 for an empty slot)
+#   record: key length, value length, utf-8 key, utf-8 value
+COMPILED_CACHE_MAGIC = b'TNEC'
+COMPILED_CACHE_VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+SLOT = struct.Struct('<QQ')
+RECORD_HEADER = struct.Struct('<II')
+# Slots per record; open addressing with linear probing stays short below half full
+SLOTS_PER_RECORD = 2
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def slot_count_for(records: int) -> int:
+    slots = 1
+    while slots < records * SLOTS_PER_RECORD:
+        slots <<= 1
+    return slots
+
+
+def compile_translation_cache(db_path: Path, output_path: Path) -> int:
+    """
+    Writes the translations table of the SQLite cache as a compiled cache file and returns the number
+    of translations. The file is written next to the output and renamed over it, so readers that have
+    the previous file mapped keep a consistent view.
+    """
+    # autocommit, so the count and the rows are read in one explicit transaction: a build or journal
+    # checkpoint writing meanwhile cannot add rows the slot table was not sized for
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        connection.execute('BEGIN')
+        records = connection.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+        slot_count = slot_count_for(records)
+        mask = slot_count - 1
+        slots = bytearray(slot_count * SLOT.size)
+        records_offset = HEADER.size + len(slots)
+
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        with tempfile.NamedTemporaryFile(mode='wb', dir=output_dir, delete=False) as temp_file:
+            try:
+                temp_file.seek(records_offset)
+                offset = records_offset
+                written = 0
+                for original_text, translated_text in connection.execute(
+                        'SELECT original_text, translated_text FROM translations'):
+                    if written == records:
+                        # a full slot table would make the probe below loop forever
+                        raise RuntimeError(f"More translations in {db_path} than the {records} counted")
+
+                    key = original_text.encode('utf-8')
+                    value = translated_text.encode('utf-8')
+                    hashed = key_hash(key)
+
+                    slot = hashed & mask
+                    while SLOT.unpack_from(slots, slot * SLOT.size)[1]:
+                        slot = (slot + 1) & mask
+                    SLOT.pack_into(slots, slot * SLOT.size, hashed, offset)
+
+                    temp_file.write(RECORD_HEADER.pack(len(key), len(value)))
+                    temp_file.write(key)
+                    temp_file.write(value)
+                    offset += RECORD_HEADER.size + len(key) + len(value)
+                    written += 1
+
+                temp_file.seek(0)
+                temp_file.write(HEADER.pack(COMPILED_CACHE_MAGIC, COMPILED_CACHE_VERSION, slot_count, written))
+                temp_file.write(slots)
+            except BaseException:
+                os.unlink(temp_file.name)
+                raise
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+    os.replace(temp_file.name, output_path)
+    return written
+
+
+class CompiledTranslationCache:
+    """
+    Read-only, memory-mapped hash table of translations written by compile_translation_cache.
+    A lookup hashes the text and probes the mapped slots, with no SQL involved; processes that map
+    the same file share its pages through the page cache, and threads can share one instance.
+    """
+
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self._file = open(cache_path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            self._file.close()
+            raise ValueError(f"{cache_path} is not a compiled translation cache")
+
+        magic, version, self.slot_count, self.records = HEADER.unpack_from(self._map, 0)
+        if magic != COMPILED_CACHE_MAGIC or version != COMPILED_CACHE_VERSION:
+            self.close()
+            raise ValueError(f"{cache_path} is not a compiled translation cache of version {COMPILED_CACHE_VERSION}")
+        self._mask = self.slot_count - 1
+
+    def get(self, text: str) -> Optional[str]:
+        key = text.encode('utf-8')
+        hashed = key_hash(key)
+        slot = hashed & self._mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._map, HEADER.size + slot * SLOT.size)
+            if not offset:
+                return None
+
+            if slot_hash == hashed:
+                key_length, value_length = RECORD_HEADER.unpack_from(self._map, offset)
+                key_start = offset + RECORD_HEADER.size
+                # the hash is only 8 bytes, so the key itself decides
+                if self._map[key_start:key_start + key_length] == key:
+                    value_start = key_start + key_length
+                    return self._map[value_start:value_start + value_length].decode('utf-8')
+
+            slot = (slot + 1) & self._mask
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CompiledCacheTranslator:
+    """
+    Puts a compiled cache in front of a translator, keeping its execute/close interface.
+    """
+
+    def __init__(self, translator, compiled_cache: CompiledTranslationCache):
+        self.translator = translator
+        self.compiled_cache = compiled_cache
+
+    def execute(self, text: str) -> Optional[str]:
+        translated_text = self.compiled_cache.get(text)
+        if translated_text is not None:
+            return translated_text
+
+        return self.translator.execute(text=text)
+
+    def close(self) -> None:
+        self.translator.close()
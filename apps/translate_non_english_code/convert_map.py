@@ -0,0 +1,21 @@
+from pathlib import Path
+from typing import Any, Optional
+
+from kwiq.core.flow import Flow
+from translate_non_english_code.map_io import read_map, resolve_map_format, write_map
+
+
+# Converts a translation map between the YAML and JSON lines formats
+class ConvertMap(Flow):
+    name: str = "convert-map"
+
+    def fn(self, input_path: Path, output_path: Path,
+           input_format: Optional[str] = None, output_format: Optional[str] = None) -> Any:
+        """
+        Convert a map file record by record; formats default to what the file extensions say.
+        """
+        input_format = resolve_map_format(input_path, input_format)
+        output_format = resolve_map_format(output_path, output_format)
+
+        records = write_map(output_path, read_map(input_path, input_format), output_format)
+        print(f"Converted {records} records from {input_path} ({input_format}) to {output_path} ({output_format})")
@@ -0,0 +1,234 @@
+import os
+import re
+import subprocess
+import time
+
+WALK_DISCOVERY = 'walk'
+SCANDIR_DISCOVERY = 'scandir'
+GIT_DISCOVERY = 'git'
+DISCOVERY_MODES = [WALK_DISCOVERY, SCANDIR_DISCOVERY, GIT_DISCOVERY]
+
+GITIGNORE_FILE_NAME = '.gitignore'
+
+
+def translate_gitignore_glob(pattern):
+    """
+    Regex for a gitignore glob: * and ? stay within a path segment, ** spans segments.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            if pattern.startswith('**', i):
+                if i + 2 == len(pattern):
+                    parts.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    parts.append('(?:.*/)?')
+                    i += 3
+                    continue
+            while i < len(pattern) and pattern[i] == '*':
+                i += 1
+            parts.append('[^/]*')
+            continue
+        if char == '?':
+            parts.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                parts.append(re.escape(char))
+            else:
+                content = pattern[i + 1:end].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                parts.append(f'[{content}]')
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+
+    return ''.join(parts)
+
+
+def parse_gitignore(lines, directory):
+    """
+    (regex, negated, directory_only) rules of a .gitignore, with regexes that match paths
+    relative to the search directory; directory is the relative path of the .gitignore's directory.
+    """
+    prefix = re.escape(directory + '/') if directory else ''
+    rules = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        if not line or line.startswith('#'):
+            continue
+
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+
+        # A slash anywhere but at the end anchors the pattern to the .gitignore's directory
+        anchored = '/' in line
+        body = translate_gitignore_glob(line.lstrip('/'))
+        regex = prefix + body if anchored else prefix + '(?:.*/)?' + body
+        rules.append((regex, negated, directory_only))
+
+    return rules
+
+
+class IgnoreRules:
+    """
+    The ignore rules in effect in one directory: its parent's rules followed by its own .gitignore,
+    compiled once. Without negations every rule can be folded into a single alternation.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.negated = any(negated for _, negated, _ in rules)
+        if self.negated:
+            self.compiled_rules = [(re.compile(regex), negated, directory_only)
+                                   for regex, negated, directory_only in reversed(rules)]
+        else:
+            self.file_regex = IgnoreRules.compile_alternation(
+                [regex for regex, _, directory_only in rules if not directory_only])
+            self.directory_regex = IgnoreRules.compile_alternation([regex for regex, _, _ in rules])
+
+    @classmethod
+    def compile_alternation(cls, regexes):
+        if not regexes:
+            return None
+        return re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+
+    def is_ignored(self, relative_path, is_dir):
+        if not self.negated:
+            regex = self.directory_regex if is_dir else self.file_regex
+            return regex is not None and regex.fullmatch(relative_path) is not None
+
+        # The last matching rule decides
+        for regex, negated, directory_only in self.compiled_rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.fullmatch(relative_path):
+                return not negated
+        return False
+
+
+class CachedGitIgnoreMatcher:
+    """
+    Front-end for matching the .gitignore files of a tree. The rules are compiled once per directory
+    level and memoized by directory; directories without a .gitignore share their parent's compiled rules.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = os.fspath(base_dir)
+        self.directory_rules = {}
+        self.calls = 0
+        self.seconds = 0.0
+
+    def rules_for(self, directory, has_gitignore=None):
+        """
+        The compiled rules in effect in the directory, given relative to the base directory.
+        """
+        rules = self.directory_rules.get(directory)
+        if rules is not None:
+            return rules
+
+        parent_rules = self.rules_for(os.path.dirname(directory)) if directory else IgnoreRules([])
+        gitignore_path = os.path.join(self.base_dir, directory, GITIGNORE_FILE_NAME)
+        if has_gitignore is None:
+            has_gitignore = os.path.isfile(gitignore_path)
+
+        rules = parent_rules
+        if has_gitignore:
+            with open(gitignore_path, 'r', encoding='utf-8', errors='replace') as gitignore_file:
+                own_rules = parse_gitignore(gitignore_file, directory)
+            if own_rules:
+                rules = IgnoreRules(parent_rules.rules + own_rules)
+
+        self.directory_rules[directory] = rules
+        return rules
+
+    def is_entry_ignored(self, entry, directory, rules, is_dir):
+        """
+        Decision for an os.scandir entry of a directory that is not ignored itself, with the directory's rules.
+        """
+        start = time.perf_counter()
+        relative_path = f'{directory}/{entry.name}' if directory else entry.name
+        ignored = rules.is_ignored(relative_path, is_dir)
+        self.calls += 1
+        self.seconds += time.perf_counter() - start
+        return ignored
+
+
+def scan_directory(search_directory, is_candidate, matcher=None):
+    """
+    Walk the tree with os.scandir, in os.walk's top-down order, and return the paths of the candidate
+    files that are neither hidden nor ignored. The type of every entry comes from scandir, so there
+    are no extra stat calls, and ignored or hidden directories are never entered.
+    """
+    matcher = matcher or CachedGitIgnoreMatcher(search_directory)
+    root = os.fspath(search_directory)
+    file_paths = []
+    pending = [(root, '')]
+    while pending:
+        directory_path, directory = pending.pop()
+        try:
+            with os.scandir(directory_path) as scanned:
+                entries = list(scanned)
+        except OSError:
+            continue
+
+        rules = matcher.rules_for(directory, any(entry.name == GITIGNORE_FILE_NAME for entry in entries))
+        subdirectories = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            if entry.is_dir():
+                # Like os.walk, symlinked directories are not followed
+                if not entry.is_symlink() and not matcher.is_entry_ignored(entry, directory, rules, True):
+                    subdirectories.append((entry.path, f'{directory}/{entry.name}' if directory else entry.name))
+            elif is_candidate(entry.name) and not matcher.is_entry_ignored(entry, directory, rules, False):
+                file_paths.append(entry.path)
+
+        pending.extend(reversed(subdirectories))
+
+    return file_paths
+
+
+def git_ls_files(search_directory, is_candidate):
+    """
+    Paths of the tracked and untracked, not ignored candidate files under the directory as listed by git,
+    in git's order; hidden files and files in hidden directories are left out as in the other modes.
+    Returns None when the directory is not inside a git work tree.
+    """
+    try:
+        output = subprocess.run(['git', '-C', os.fspath(search_directory), 'ls-files', '-z', '--cached', '--others',
+                                 '--exclude-standard'], check=True, capture_output=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    file_paths = []
+    # Unmerged paths are listed once per stage
+    for relative_path in dict.fromkeys(os.fsdecode(path) for path in output.split(b'\0') if path):
+        if not is_candidate(os.path.basename(relative_path)):
+            continue
+        if any(part.startswith('.') for part in relative_path.split('/')):
+            continue
+
+        file_path = os.path.join(search_directory, relative_path)
+        # Deleted tracked files are still in the index
+        if os.path.isfile(file_path):
+            file_paths.append(file_path)
+
+    return file_paths
@@ -0,0 +1,164 @@
+import cProfile
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+# Keys of worker stats ending with this are stage timings, every other key is a counter
+SECONDS_SUFFIX = '_seconds'
+
+
+class Instrumentation:
+    """
+    Per-stage timers and counters of a flow run, written as a JSON report at the end of the run.
+
+    Stage times are cumulative: stages timed on several threads or worker processes add up, so they
+    can exceed the wall time. The optional cProfile dump only covers the main process.
+    """
+
+    def __init__(self, flow_name: str, report_path: Optional[Path] = None, profile_path: Optional[Path] = None):
+        self.flow_name = flow_name
+        self.report_path = report_path
+        self.profile_path = profile_path
+        self.stages = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._started_at = None
+        self._start = None
+
+    def start(self) -> 'Instrumentation':
+        self._started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+
+    def timed_iter(self, iterable, name: str):
+        """
+        Yields the items of iterable, timing how long producing each one takes as the stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start, calls=0)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def merge(self, stats: dict) -> None:
+        """
+        Adds the stats a worker returned for one unit of work.
+        """
+        for name, value in stats.items():
+            if name.endswith(SECONDS_SUFFIX):
+                self.add_time(name[:-len(SECONDS_SUFFIX)], value)
+            else:
+                self.count(name, value)
+
+    def report(self) -> dict:
+        return {
+            'flow': self.flow_name,
+            'started_at': self._started_at.isoformat() if self._started_at else None,
+            'wall_seconds': time.perf_counter() - self._start if self._start is not None else None,
+            'stages': {name: dict(stage) for name, stage in sorted(self.stages.items())},
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def finish(self) -> dict:
+        """
+        Stops the profiler and writes the profile and the report, when asked for.
+        """
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            print(f"Wrote cProfile stats to: {self.profile_path}")
+
+        report = self.report()
+        if self.report_path:
+            with open(self.report_path, 'w', encoding='utf-8') as report_file:
+                json.dump(report, report_file, indent=2)
+            print(f"Wrote instrumentation report to: {self.report_path}")
+
+        return report
+
+
+class NoInstrumentation(Instrumentation):
+    """
+    Stands in for Instrumentation when neither a report nor a profile is asked for: stages and timed
+    iterables are not timed at all and nothing is written. Counters are still kept, flows print them.
+    It is falsy, so the wrappers that only exist for timing are left out as well.
+    """
+
+    _no_stage = nullcontext()
+
+    def __bool__(self) -> bool:
+        return False
+
+    def start(self) -> 'NoInstrumentation':
+        return self
+
+    def stage(self, name: str):
+        return self._no_stage
+
+    def add_time(self, name: str, seconds: float, calls: int = 1) -> None:
+        pass
+
+    def timed_iter(self, iterable, name: str):
+        return iterable
+
+    def finish(self) -> dict:
+        return self.report()
+
+
+def start_instrumentation(flow_name: str, report_path: Optional[Path] = None,
+                          profile_path: Optional[Path] = None) -> Instrumentation:
+    """
+    Starts the instrumentation of a flow run, a no-op one unless a report or a profile is asked for.
+    """
+    if report_path or profile_path:
+        return Instrumentation(flow_name, report_path, profile_path).start()
+    return NoInstrumentation(flow_name)
+
+
+class TimedTranslator:
+    """
+    Times the calls of a translator as the translation stage, keeping its execute/close interface.
+    """
+
+    def __init__(self, translator, instrumentation: Instrumentation):
+        self.translator = translator
+        self.instrumentation = instrumentation
+
+    def execute(self, text: str) -> Optional[str]:
+        with self.instrumentation.stage('translation'):
+            return self.translator.execute(text=text)
+
+    def close(self) -> None:
+        self.translator.close()
@@ -0,0 +1,114 @@
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import yaml
+
+# libyaml's C loader and dumper are an order of magnitude faster than the pure Python ones. Their output
+# loads back to the same data, though long quoted scalars may be wrapped at different points.
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+
+    YAML_BACKEND = 'libyaml'
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+    YAML_BACKEND = 'pure-python'
+
+YAML_DUMP_OPTIONS = {'allow_unicode': True, 'default_style': '', 'default_flow_style': False}
+
+YAML_FORMAT = 'yaml'
+JSONL_FORMAT = 'jsonl'
+MAP_FORMATS = [YAML_FORMAT, JSONL_FORMAT]
+JSONL_FILE_EXTENSIONS = ['.jsonl', '.ndjson']
+
+
+def resolve_map_format(map_path: Path, map_format: Optional[str] = None) -> str:
+    """
+    The explicit format if given, else jsonl for .jsonl/.ndjson files and yaml for everything else.
+    """
+    if map_format:
+        if map_format not in MAP_FORMATS:
+            raise ValueError(f"Unknown map format: {map_format}, expected one of {MAP_FORMATS}")
+        return map_format
+
+    return JSONL_FORMAT if os.path.splitext(map_path)[1] in JSONL_FILE_EXTENSIONS else YAML_FORMAT
+
+
+def read_map(map_path: Path, map_format: Optional[str] = None) -> Iterator[dict]:
+    """
+    Yields the records of a map file. JSON lines are streamed one record at a time, while a YAML
+    map is a single document and has to be loaded as a whole.
+    """
+    with open(map_path, 'r', encoding='utf-8') as file:
+        if resolve_map_format(map_path, map_format) == JSONL_FORMAT:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            print(f"Loading YAML map {map_path} with the {YAML_BACKEND} backend")
+            yield from yaml.load(file, Loader=YamlLoader) or []
+
+
+class MapReader:
+    """
+    Re-iterable view of a map file, for flows that need more than one pass over the records.
+    JSON lines are streamed again on every pass. A YAML map is loaded as a whole anyway, so the records
+    of the first pass are kept and later passes reuse them instead of parsing the file again.
+    """
+
+    def __init__(self, map_path: Path, map_format: Optional[str] = None):
+        self.map_path = map_path
+        self.map_format = resolve_map_format(map_path, map_format)
+        self._records = None
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.map_format == JSONL_FORMAT:
+            return read_map(self.map_path, self.map_format)
+
+        if self._records is None:
+            self._records = list(read_map(self.map_path, self.map_format))
+        return iter(self._records)
+
+
+class MapWriter:
+    """
+    Writes map records one at a time. YAML records are dumped as items of the top level list,
+    which gives the same bytes as dumping the whole list at once.
+    """
+
+    def __init__(self, map_path: Path, map_format: Optional[str] = None):
+        self.map_path = map_path
+        self.map_format = resolve_map_format(map_path, map_format)
+        self.records = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.map_path, 'w', encoding='utf-8')
+        if self.map_format == YAML_FORMAT:
+            print(f"Writing YAML map {self.map_path} with the {YAML_BACKEND} backend")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.map_format == YAML_FORMAT and self.records == 0:
+            yaml.dump([], self._file, Dumper=YamlDumper, **YAML_DUMP_OPTIONS)
+        self._file.close()
+
+    def write(self, record: dict) -> None:
+        if self.map_format == JSONL_FORMAT:
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            self._file.write('\n')
+        else:
+            yaml.dump([record], self._file, Dumper=YamlDumper, **YAML_DUMP_OPTIONS)
+        self.records += 1
+
+
+def write_map(map_path: Path, records: Iterable[dict], map_format: Optional[str] = None) -> int:
+    """
+    Writes all the records to the map file and returns how many were written.
+    """
+    with MapWriter(map_path, map_format) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.records
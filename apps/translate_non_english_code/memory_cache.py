@@ -0,0 +1,116 @@
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+def entry_size(text: str, translated_text: str) -> int:
+    return sys.getsizeof(text) + sys.getsizeof(translated_text)
+
+
+class MemoryTranslationCache:
+    """
+    Bounded in-process LRU of translations, sized by the memory of the cached strings.
+    Safe to share between the threads of a batch translation.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[str]:
+        with self._lock:
+            translated_text = self._entries.get(text)
+            if translated_text is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return translated_text
+
+    def put(self, text: str, translated_text: str) -> None:
+        size = entry_size(text, translated_text)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(text, None)
+            if previous is not None:
+                self.size -= entry_size(text, previous)
+
+            self._entries[text] = translated_text
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_text, evicted_translation = self._entries.popitem(last=False)
+                self.size -= entry_size(evicted_text, evicted_translation)
+                self.evictions += 1
+
+    def preload(self, db_path: Path) -> int:
+        """
+        Fills the cache from the translations table with one sequential scan, stopping once it is full.
+        """
+        loaded = 0
+        connection = sqlite3.connect(db_path)
+        try:
+            for text, translated_text in connection.execute(
+                    'SELECT original_text, translated_text FROM translations'):
+                size = entry_size(text, translated_text)
+                if self.size + size > self.max_bytes:
+                    break
+                self._entries[text] = translated_text
+                self.size += size
+                loaded += 1
+        finally:
+            connection.close()
+
+        print(f"Preloaded {loaded} translations ({self.size} bytes) from {db_path}")
+        return loaded
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def print_stats(self) -> None:
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups else 0.0
+        print(f"Memory translation cache: {stats['entries']} entries, {stats['bytes']}/{stats['max_bytes']} bytes, "
+              f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%} hit rate), "
+              f"{stats['evictions']} evictions")
+
+
+class CachedTranslator:
+    """
+    Puts a memory cache in front of a translator, keeping its execute/close interface.
+    """
+
+    def __init__(self, translator, memory_cache: MemoryTranslationCache):
+        self.translator = translator
+        self.memory_cache = memory_cache
+
+    def execute(self, text: str) -> Optional[str]:
+        translated_text = self.memory_cache.get(text)
+        if translated_text is not None:
+            return translated_text
+
+        translated_text = self.translator.execute(text=text)
+        if translated_text is not None:
+            self.memory_cache.put(text, translated_text)
+        return translated_text
+
+    def close(self) -> None:
+        self.translator.close()
@@ -1,59 +1,255 @@
+import mmap
 import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any
-
-import yaml
+from typing import Any, Optional
 
 from kwiq.core.flow import Flow
 from kwiq.task.gitignore_matcher import GitIgnoreMatcher
-from translate_non_english_code.utils import replace_full_width_chars, is_english_or_technical, LANG_PATTERNS, \
-    WHOLE_LINE_PATTERN, find_non_english_chunks
+from translate_non_english_code.file_discovery import CachedGitIgnoreMatcher, DISCOVERY_MODES, GIT_DISCOVERY, \
+    SCANDIR_DISCOVERY, WALK_DISCOVERY, git_ls_files, scan_directory
+from translate_non_english_code.instrumentation import start_instrumentation
+from translate_non_english_code.map_io import MapWriter
+from translate_non_english_code.scan_manifest import ScanManifest, current_git_state
+from translate_non_english_code.translation_units import TranslationUnitIndex
+from translate_non_english_code.utils import analyze_text, LANG_PATTERNS, CODE_SCANNERS, NON_TECHNICAL_BYTE_PATTERN, \
+    split_block_decoration
 
-# 'multi_line_comment', 'multi_line_string',
-PATTERN_CHECK_SEQUENCE = ['single_line_comment', 'single_line_string']
 MARKDOWN_FILE_EXTENSIONS = [".md"]
 TEXT_FILE_EXTENSIONS = [".text", ".txt"]
+SCANNED_FILE_EXTENSIONS = frozenset([*LANG_PATTERNS, *MARKDOWN_FILE_EXTENSIONS, *TEXT_FILE_EXTENSIONS])
+# Files at least this large are checked through mmap instead of being read into memory
+MMAP_THRESHOLD = 1024 * 1024
 
 
 # Process files for non-English text.
 class PrepareForTranslation(Flow):
     name: str = "prepare-translation"
 
-    def fn(self, search_directory: Path, output_file: Path) -> Any:
-        project_map = []
+    def fn(self, search_directory: Path, output_file: Path, workers: int = 1,
+           manifest_path: Optional[Path] = None, since_revision: Optional[str] = None,
+           map_format: Optional[str] = None, report_path: Optional[Path] = None,
+           profile_path: Optional[Path] = None, discovery: str = WALK_DISCOVERY, intern_units: bool = False) -> Any:
+        if since_revision and not manifest_path:
+            raise ValueError("since_revision only skips files with an entry in the manifest, it requires manifest_path")
+
+        instrumentation = start_instrumentation(self.name, report_path, profile_path)
+        file_paths = PrepareForTranslation.discover_files(search_directory, instrumentation, discovery)
+
+        cached_file_maps = {}
+        manifest = ScanManifest(manifest_path) if manifest_path else None
+        revision, dirty_files = None, set()
+        if manifest:
+            changed_files = None
+            if since_revision:
+                # the state before scanning: a file changed during the run shows up as changed next time
+                revision, dirty_files = current_git_state(search_directory)
+                changed_files = manifest.untrusted_files(search_directory, since_revision)
+            file_paths_to_scan = []
+            content_hashes = {}
+            for file_path in file_paths:
+                trust_unchanged = changed_files is not None and os.path.realpath(file_path) not in changed_files
+                with instrumentation.stage('manifest_lookup'):
+                    found, file_map, content_hash = manifest.lookup(file_path, trust_unchanged=trust_unchanged)
+                if found:
+                    cached_file_maps[file_path] = file_map
+                else:
+                    file_paths_to_scan.append(file_path)
+                    content_hashes[file_path] = content_hash
+            print(f"Reusing {len(cached_file_maps)} file maps from {manifest_path}, "
+                  f"scanning {len(file_paths_to_scan)} files")
+        else:
+            file_paths_to_scan = file_paths
+
+        instrumentation.count('files_cached', len(cached_file_maps))
+        scan_results = PrepareForTranslation.process_files(file_paths_to_scan, workers)
+        unit_index = TranslationUnitIndex() if intern_units else None
+
+        def project_map():
+            # Scan results come back in the order of file_paths, so cached and scanned maps merge in one pass
+            for file_path in file_paths:
+                if file_path in cached_file_maps:
+                    file_map = cached_file_maps.pop(file_path)
+                else:
+                    _, file_map, file_stats = next(scan_results)
+                    instrumentation.merge(file_stats)
+                    if manifest:
+                        manifest.update(file_path, content_hashes[file_path], file_map)
+
+                if file_map:
+                    if unit_index:
+                        units, file_map = unit_index.intern(file_map)
+                        yield from units
+                    yield {'file': file_path, 'map': file_map}
+
+        # Write the map to a file in YAML or JSON lines format
+        with MapWriter(output_file, map_format) as writer:
+            for record in project_map():
+                with instrumentation.stage('serialization'):
+                    writer.write(record)
+
+        if manifest:
+            with instrumentation.stage('manifest_save'):
+                manifest.save(revision, dirty_files)
+
+        if unit_index:
+            instrumentation.count('units', len(unit_index.unit_ids))
+            print(f"Interned {unit_index.references} map entries as {len(unit_index.unit_ids)} translation units")
+
+        counters = instrumentation.counters
+        print(f"Skipped {counters['files_skipped']} of {len(file_paths_to_scan)} scanned files "
+              f"({counters['bytes_skipped']} bytes) without non-technical characters")
+        instrumentation.finish()
+
+    @classmethod
+    def discover_files(cls, search_directory, instrumentation=None, discovery=WALK_DISCOVERY):
+        """
+        Find the files to process in the directory, ignoring those that match .gitignore patterns.
+        walk checks every path with GitIgnoreMatcher, scandir matches the .gitignore rules compiled per
+        directory level, and git takes the tracked and untracked files git ls-files does not ignore.
+        """
+        if discovery not in DISCOVERY_MODES:
+            raise ValueError(f"Unknown discovery mode: {discovery}, expected one of {DISCOVERY_MODES}")
+
+        start = time.perf_counter()
+        if discovery == GIT_DISCOVERY:
+            file_paths = git_ls_files(search_directory, cls.is_candidate_file)
+            if file_paths is not None:
+                if instrumentation:
+                    instrumentation.add_time('git_ls_files', time.perf_counter() - start)
+                    instrumentation.count('files_discovered', len(file_paths))
+                return file_paths
+
+            print(f"{search_directory} is not in a git work tree, discovering files with scandir")
+            discovery = SCANDIR_DISCOVERY
+
+        if discovery == SCANDIR_DISCOVERY:
+            gitignore_matcher = CachedGitIgnoreMatcher(search_directory)
+            file_paths = scan_directory(search_directory, cls.is_candidate_file, gitignore_matcher)
+            gitignore_seconds, gitignore_calls = gitignore_matcher.seconds, gitignore_matcher.calls
+        else:
+            file_paths, gitignore_seconds, gitignore_calls = cls.walk_files(search_directory)
+
+        if instrumentation:
+            instrumentation.add_time('walk', time.perf_counter() - start - gitignore_seconds)
+            instrumentation.add_time('gitignore', gitignore_seconds, gitignore_calls)
+            instrumentation.count('files_discovered', len(file_paths))
+        return file_paths
+
+    @classmethod
+    def walk_files(cls, search_directory):
+        """
+        Find the files with os.walk, asking GitIgnoreMatcher about every directory and file.
+        Returns the file paths along with the time spent matching and the number of matches.
+        """
+        file_paths = []
         gitignore_matcher = GitIgnoreMatcher(base_dir=search_directory)
+        gitignore_seconds = 0.0
+        gitignore_calls = 0
+
+        def is_ignored(path):
+            nonlocal gitignore_seconds, gitignore_calls
+            match_start = time.perf_counter()
+            ignored = gitignore_matcher.execute(file_path=path)
+            gitignore_seconds += time.perf_counter() - match_start
+            gitignore_calls += 1
+            return ignored
 
-        """Process files in the directory, ignoring those that match .gitignore patterns."""
         for root, dirs, files in os.walk(search_directory):
             # Filter ignored directories
             dirs[:] = [d for d in dirs if not d.startswith('.')
-                       and not gitignore_matcher.execute(file_path=os.path.join(root, d))]
+                       and not is_ignored(os.path.join(root, d))]
 
             for file in files:
+                if not cls.is_candidate_file(file):
+                    continue
+
                 file_path = os.path.join(root, file)
-                if not file.startswith('.') and not gitignore_matcher.execute(file_path=file_path):
-                    # Process file
-                    file_ext = os.path.splitext(file)[1]
-                    file_path = os.path.join(root, file)
-                    file_map = None
-                    if file_ext in LANG_PATTERNS:
-                        print(f"Processing file: {file_path}")
-                        patterns = LANG_PATTERNS[file_ext]
-                        file_map = PrepareForTranslation.process_file(file_path, patterns)
-                    elif file_ext in MARKDOWN_FILE_EXTENSIONS:
-                        print(f"Processing markdown file: {file_path}")
-                        file_map = PrepareForTranslation.process_markdown_file(file_path)
-                    elif file_ext in TEXT_FILE_EXTENSIONS:
-                        print(f"Processing text file: {file_path}")
-                        file_map = PrepareForTranslation.process_text_file(file_path)
-
-                    if file_map:
-                        project_map.append({'file': file_path, 'map': file_map})
-
-        # Write the map to a file in JSON format
-        with open(output_file, 'w', encoding='utf-8') as map_file:
-            yaml.dump(project_map, map_file, allow_unicode=True, default_style='')
+                if not file.startswith('.') and not is_ignored(file_path):
+                    file_paths.append(file_path)
+
+        return file_paths, gitignore_seconds, gitignore_calls
+
+    @classmethod
+    def is_candidate_file(cls, file_name):
+        return os.path.splitext(file_name)[1] in SCANNED_FILE_EXTENSIONS
+
+    @classmethod
+    def process_files(cls, file_paths, workers=1):
+        """
+        Yield (file_path, file_map, stats) for every file, in the order of file_paths.
+        With more than one worker the files are spread across a process pool.
+        """
+        if workers <= 1 or len(file_paths) <= 1:
+            results = map(cls.process_path, file_paths)
+            for file_path, (file_map, stats) in zip(file_paths, results):
+                yield file_path, file_map, stats
+            return
+
+        chunk_size = max(1, min(64, len(file_paths) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() hands the results back in submission order, so the merged map is deterministic
+            results = executor.map(cls.process_path, file_paths, chunksize=chunk_size)
+            for file_path, (file_map, stats) in zip(file_paths, results):
+                yield file_path, file_map, stats
+
+    @classmethod
+    def process_path(cls, file_path):
+        """
+        Returns the file map of the file and counters and timings about how it was processed.
+        """
+        start = time.perf_counter()
+        size, technical = cls.check_technical_file(file_path)
+        prefilter_seconds = time.perf_counter() - start
+        if technical:
+            return None, {'files_skipped': 1, 'bytes_skipped': size, 'prefilter_seconds': prefilter_seconds}
+
+        stats = {'files_scanned': 1, 'bytes_scanned': size, 'prefilter_seconds': prefilter_seconds}
+        file_ext = os.path.splitext(file_path)[1]
+        file_map = None
+        if file_ext in LANG_PATTERNS:
+            print(f"Processing file: {file_path}")
+            file_map = PrepareForTranslation.process_file(file_path, CODE_SCANNERS[file_ext], stats)
+        elif file_ext in MARKDOWN_FILE_EXTENSIONS:
+            print(f"Processing markdown file: {file_path}")
+            file_map = PrepareForTranslation.process_markdown_file(file_path, stats)
+        elif file_ext in TEXT_FILE_EXTENSIONS:
+            print(f"Processing text file: {file_path}")
+            file_map = PrepareForTranslation.process_text_file(file_path, stats)
+
+        stats['scan_seconds'] = time.perf_counter() - start - prefilter_seconds - stats.get('aggregation_seconds', 0)
+        return file_map, stats
+
+    @classmethod
+    def check_technical_file(cls, file_path):
+        """
+        Returns the size of the file and whether it has no byte outside the technical ASCII set.
+        """
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return size, True
+
+            if size < MMAP_THRESHOLD:
+                content = file.read()
+                return size, NON_TECHNICAL_BYTE_PATTERN.search(content) is None
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return size, NON_TECHNICAL_BYTE_PATTERN.search(content) is None
+
+    @classmethod
+    def aggregate_file_map(cls, non_english_map, line_count, stats=None):
+        if stats is None:
+            return cls.aggregate_data(non_english_map)
+
+        start = time.perf_counter()
+        file_map = cls.aggregate_data(non_english_map)
+        stats['aggregation_seconds'] = time.perf_counter() - start
+        stats['lines'] = line_count
+        stats['matches'] = len(non_english_map)
+        return file_map
 
     @classmethod
     def aggregate_data(cls, data):
@@ -61,22 +257,27 @@ class PrepareForTranslation(Flow):
         for entry in data:
             original_text = entry['original_text']
             position = entry.get('position')
+            line_count = entry.get('line_count', 1)
+            # the same text as a block and on a single line needs separate entries
+            key = (original_text, line_count)
 
-            if original_text not in aggregated_map:
-                aggregated_map[original_text] = {
+            if key not in aggregated_map:
+                aggregated_map[key] = {
                     'original_text': original_text,
                     'positions': []
                 }
 
                 # Conditionally add fields if they are not None
                 if entry.get('translation_input') is not None:
-                    aggregated_map[original_text]['translation_input'] = entry['translation_input']
-                    aggregated_map[original_text]['chunks'] = entry['chunks']
+                    aggregated_map[key]['translation_input'] = entry['translation_input']
+                    aggregated_map[key]['chunks'] = entry['chunks']
                 if entry.get('translated_text') is not None:
-                    aggregated_map[original_text]['translated_text'] = entry['translated_text']
+                    aggregated_map[key]['translated_text'] = entry['translated_text']
+                if line_count > 1:
+                    aggregated_map[key]['line_count'] = line_count
 
             if position is not None:
-                aggregated_map[original_text]['positions'].append(position)
+                aggregated_map[key]['positions'].append(position)
 
         return list(aggregated_map.values())
 
@@ -84,16 +285,20 @@ class PrepareForTranslation(Flow):
     def process_regular_text(cls, line_number, text):
         non_english_map_entry = None
         original_text = text
-        processed_text = replace_full_width_chars(text)
+        analysis = analyze_text(text)
 
-        if not is_english_or_technical(processed_text):
+        if analysis is None:
+            return non_english_map_entry
+
+        processed_text, chunks = analysis
+        if chunks is not None:
             non_english_map_entry = {
                 'position': line_number,
                 'original_text': original_text,
                 'translation_input': processed_text,
-                'chunks': find_non_english_chunks(processed_text),
+                'chunks': list(chunks),
             }
-        elif text != processed_text:
+        else:
             non_english_map_entry = {
                 'position': line_number,
                 'original_text': original_text,
@@ -133,7 +338,7 @@ class PrepareForTranslation(Flow):
                 break
 
     @classmethod
-    def process_markdown_file(cls, file_path):
+    def process_markdown_file(cls, file_path, stats=None):
         non_english_map = []
 
         with open(file_path, 'r', encoding='utf-8') as file:
@@ -149,10 +354,10 @@ class PrepareForTranslation(Flow):
                 else:
                     PrepareForTranslation.process_markdown_line(line_number, stripped_line, non_english_map)
 
-        return PrepareForTranslation.aggregate_data(non_english_map)
+        return PrepareForTranslation.aggregate_file_map(non_english_map, line_number, stats)
 
     @classmethod
-    def process_text_file(cls, file_path):
+    def process_text_file(cls, file_path, stats=None):
         non_english_map = []
 
         with open(file_path, 'r', encoding='utf-8') as file:
@@ -165,56 +370,46 @@ class PrepareForTranslation(Flow):
                 if result:
                     non_english_map.append(result)
 
-        return PrepareForTranslation.aggregate_data(non_english_map)
+        return PrepareForTranslation.aggregate_file_map(non_english_map, line_number, stats)
 
     @classmethod
-    def process_file(cls, file_path, patterns):
+    def process_file(cls, file_path, scanner, stats=None):
         non_english_map = []
 
         with open(file_path, 'r', encoding='utf-8') as file:
-            line_number = 0
-            for content in file:
-                line_number += 1
-                for pattern_type in PATTERN_CHECK_SEQUENCE:
-                    for pattern in patterns.get(pattern_type, []):
-                        while True:
-                            content, match = cls.match_pattern_for_code_file(content,
-                                                                             line_number,
-                                                                             non_english_map,
-                                                                             pattern)
-                            if not match:
-                                break
-
-                # match the whole line as a fallback
-                cls.match_pattern_for_code_file(content, line_number, non_english_map, WHOLE_LINE_PATTERN)
+            last_line = 0
+            # the rest of every line is tokenized too, as a fallback
+            for line_number, line_count, text in scanner.tokenize(file):
+                cls.process_code_text(line_number, text, non_english_map, line_count)
+                last_line = line_number + line_count - 1
 
-        return PrepareForTranslation.aggregate_data(non_english_map)
+        return PrepareForTranslation.aggregate_file_map(non_english_map, last_line, stats)
 
     @classmethod
-    def match_pattern_for_code_file(cls, content, line_number, non_english_map, pattern):
-        match = re.search(pattern, content, re.DOTALL)
-        if match:
-            matched_content = match.group(1)
-            # print("Matched pattern: ", pattern, matched_content)
-            stripped_line = matched_content.strip()
-            lines_without_full_width_chars = replace_full_width_chars(stripped_line)
-            if lines_without_full_width_chars and not is_english_or_technical(
-                    lines_without_full_width_chars):
-                non_english_map.append(
-                    {
-                        'position': line_number,
-                        'original_text': stripped_line,
-                        'translation_input': lines_without_full_width_chars,
-                        'chunks': find_non_english_chunks(lines_without_full_width_chars),
-                    })
-            elif stripped_line != lines_without_full_width_chars:
-                non_english_map.append({
-                    'position': line_number,
-                    'original_text': stripped_line,
-                    'translated_text': lines_without_full_width_chars
-                })
-
-            # Replace matched text with spaces, preserving newline characters
-            content = content[:match.start()] + '' + content[match.end():]
-
-        return content, match
+    def process_code_text(cls, line_number, matched_content, non_english_map, line_count=1):
+        stripped_line = matched_content.strip()
+        # the indentation and ' * ' of the lines of a block are layout, the translator only gets the text
+        text = split_block_decoration(stripped_line)[1] if line_count > 1 else stripped_line
+        analysis = analyze_text(text)
+        if analysis is None:
+            return
+
+        lines_without_full_width_chars, chunks = analysis
+        if chunks is not None:
+            entry = {
+                'position': line_number,
+                'original_text': stripped_line,
+                'translation_input': lines_without_full_width_chars,
+                'chunks': list(chunks),
+            }
+        else:
+            entry = {
+                'position': line_number,
+                'original_text': stripped_line,
+                'translated_text': lines_without_full_width_chars
+            }
+
+        # a block spanning several lines is applied to all of them at once
+        if line_count > 1:
+            entry['line_count'] = line_count
+        non_english_map.append(entry)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+
+# Bump whenever the scanning logic changes the file maps it produces, so stale manifests are ignored
+MANIFEST_VERSION = 3
+
+
+def hash_file(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def git(search_directory, *args):
+    return subprocess.run(['git', '-C', str(search_directory), *args],
+                          check=True, text=True, capture_output=True).stdout
+
+
+def changed_files_since(search_directory, revision):
+    """
+    Real paths of the files changed since the git revision, including untracked files.
+    git reports paths below the real path of the work tree, so callers compare real paths too:
+    a search directory reached through a symlink would otherwise match none of them.
+    """
+    top_level = git(search_directory, 'rev-parse', '--show-toplevel').strip()
+    changed = git(search_directory, 'diff', '--name-only', '-z', revision, '--').split('\0')
+    untracked = git(search_directory, 'ls-files', '--others', '--exclude-standard', '--full-name', '-z').split('\0')
+
+    return {os.path.realpath(os.path.join(top_level, path)) for path in changed + untracked if path}
+
+
+def current_git_state(search_directory):
+    """
+    (HEAD commit, real paths of the files that differ from it) of the work tree, or (None, set())
+    outside of one. Recorded in the manifest, so a later run knows which maps match which commit.
+    """
+    try:
+        revision = git(search_directory, 'rev-parse', 'HEAD').strip()
+        return revision, changed_files_since(search_directory, revision)
+    except (subprocess.CalledProcessError, OSError):
+        return None, set()
+
+
+class ScanManifest:
+    """
+    On-disk record of the previous prepare-translation run: for every scanned file its
+    mtime, size, content hash and the file map it produced. Runs with a since revision also
+    record the git commit the run started at and the files that differed from it then.
+    """
+
+    def __init__(self, manifest_path: Path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        self.updated_entries = {}
+        self.revision = None
+        self.dirty_files = set()
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = manifest['files']
+                self.revision = manifest.get('revision')
+                self.dirty_files = set(manifest.get('dirty_files') or [])
+            else:
+                print(f"Ignoring manifest {manifest_path}: written by a different scanner version")
+
+    def lookup(self, file_path, trust_unchanged=False):
+        """
+        Returns (found, file_map, content_hash); the file has to be scanned again when not found.
+        With trust_unchanged the entry is reused without looking at the file at all.
+        """
+        entry = self.entries.get(file_path)
+        if entry is not None and trust_unchanged:
+            self.updated_entries[file_path] = entry
+            return True, entry['map'], entry['hash']
+
+        stat = os.stat(file_path)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            self.updated_entries[file_path] = entry
+            return True, entry['map'], entry['hash']
+
+        content_hash = hash_file(file_path)
+        if entry is not None and entry['hash'] == content_hash:
+            self.update(file_path, content_hash, entry['map'])
+            return True, entry['map'], content_hash
+
+        return False, None, content_hash
+
+    def untrusted_files(self, search_directory, since_revision):
+        """
+        Real paths of the files whose entries cannot be trusted without looking at them: changed since
+        since_revision, since the commit the manifest was written at, or dirty when it was written.
+        None when the manifest has no commit recorded, or it is gone, and no entry can be trusted.
+        """
+        if self.revision is None:
+            print(f"Manifest {self.manifest_path} has no git revision recorded, checking every file")
+            return None
+
+        try:
+            return (changed_files_since(search_directory, since_revision)
+                    | changed_files_since(search_directory, self.revision)
+                    | self.dirty_files)
+        except subprocess.CalledProcessError as e:
+            print(f"Cannot diff against the revision of manifest {self.manifest_path}, checking every file: "
+                  f"{e.stderr.strip()}")
+            return None
+
+    def update(self, file_path, content_hash, file_map):
+        stat = os.stat(file_path)
+        self.updated_entries[file_path] = {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hash': content_hash,
+            'map': file_map,
+        }
+
+    def save(self, revision=None, dirty_files=()):
+        """
+        Writes the entries seen in this run, files that disappeared are dropped, and the git state
+        the run started at.
+        """
+        manifest = {'version': MANIFEST_VERSION, 'files': self.updated_entries}
+        if revision:
+            manifest['revision'] = revision
+            manifest['dirty_files'] = sorted(dirty_files)
+
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', dir=manifest_dir, delete=False) as temp_file:
+            json.dump(manifest, temp_file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_file.name, self.manifest_path)
@@ -1,27 +1,183 @@
+import os
 from pathlib import Path
 from typing import Any, Optional
 
-import yaml
-
 from kwiq.core.flow import Flow
 from kwiq.task.google_translate import GoogleTranslate
+from translate_non_english_code.async_translation import AsyncBatchTranslator, GOOGLE_TRANSLATE_URL, \
+    GoogleTranslateEndpoint
+from translate_non_english_code.batch_translation import collect_translation_texts, translate_texts
+from translate_non_english_code.compiled_cache import CompiledCacheTranslator, CompiledTranslationCache
+from translate_non_english_code.instrumentation import Instrumentation, TimedTranslator, start_instrumentation
+from translate_non_english_code.map_io import MapReader, MapWriter
+from translate_non_english_code.memory_cache import CachedTranslator, MemoryTranslationCache
+from translate_non_english_code.translation_journal import JournaledTranslator, TranslationJournal
+from translate_non_english_code.translation_units import UNIT_KEY, record_entries
+
+
+GOOGLE_BACKEND = 'google'
+ASYNC_BACKEND = 'async'
+TRANSLATOR_BACKENDS = [GOOGLE_BACKEND, ASYNC_BACKEND]
+API_KEY_ENVIRONMENT_VARIABLE = 'GOOGLE_TRANSLATE_API_KEY'
 
 
 class Translate(Flow):
     name: str = "translate"
 
-    def fn(self, input_path: Path, output_path: Path, translation_cache_path: Optional[Path]) -> Any:
-        google_translator = GoogleTranslate(translation_cache_path=translation_cache_path)
+    def fn(self, input_path: Path, output_path: Path, translation_cache_path: Optional[Path],
+           batch: bool = False, batch_size: int = 50, batch_chars: int = 5000, concurrency: int = 4,
+           memory_cache_mb: int = 0, preload_memory_cache: bool = False, map_format: Optional[str] = None,
+           report_path: Optional[Path] = None, profile_path: Optional[Path] = None,
+           compiled_cache_path: Optional[Path] = None, journal_path: Optional[Path] = None,
+           checkpoint_every: int = 100, resume: bool = False, backend: str = GOOGLE_BACKEND,
+           endpoint_url: Optional[str] = None, api_key: Optional[str] = None, target_language: str = 'en',
+           rate_limit: float = 10.0, max_concurrency: int = 32) -> Any:
+        if backend not in TRANSLATOR_BACKENDS:
+            raise ValueError(f"Unknown translator backend: {backend}, expected one of {TRANSLATOR_BACKENDS}")
+
+        instrumentation = start_instrumentation(self.name, report_path, profile_path)
+        compiled_cache = CompiledTranslationCache(compiled_cache_path) if compiled_cache_path else None
+
+        journal = None
+        if journal_path:
+            journal = TranslationJournal(journal_path, checkpoint_every, resume, translation_cache_path)
+            if resume:
+                print(f"Resuming with {journal.resumed} translations completed in {journal_path}")
+
+        memory_cache = None
+        if memory_cache_mb > 0:
+            memory_cache = MemoryTranslationCache(max_bytes=memory_cache_mb * 1024 * 1024)
+            if preload_memory_cache and translation_cache_path and os.path.exists(translation_cache_path):
+                with instrumentation.stage('cache_preload'):
+                    memory_cache.preload(translation_cache_path)
+
+        # The async backend sends one request per batch, starting at concurrency requests in flight
+        async_translator = None
+        if backend == ASYNC_BACKEND:
+            endpoint = GoogleTranslateEndpoint(endpoint_url or GOOGLE_TRANSLATE_URL,
+                                               api_key or os.environ.get(API_KEY_ENVIRONMENT_VARIABLE),
+                                               target_language)
+            async_translator = AsyncBatchTranslator(endpoint, rate_limit, concurrency, max_concurrency,
+                                                    journal=journal, translation_cache_path=translation_cache_path)
+
+        # The original map is read lazily, once per pass
+        input_map = MapReader(input_path, map_format)
+
+        if batch or async_translator:
+            output_map = Translate.translate_in_batches(input_map, translation_cache_path,
+                                                        batch_size, batch_chars, concurrency, memory_cache,
+                                                        instrumentation, compiled_cache, journal, async_translator)
+        else:
+            output_map = Translate.translate_one_by_one(input_map, translation_cache_path, memory_cache,
+                                                        instrumentation, compiled_cache, journal)
+
+        with MapWriter(output_path, map_format) as writer:
+            for record in output_map:
+                with instrumentation.stage('serialization'):
+                    writer.write(record)
+                if UNIT_KEY in record:
+                    instrumentation.count('units')
+                else:
+                    instrumentation.count('files')
+                    instrumentation.count('entries', len(record['map']))
+
+        print(f"Successfully translated input and written output to: {output_path}")
+        if memory_cache:
+            memory_cache.print_stats()
+            instrumentation.merge({f'memory_cache_{name}': value for name, value in memory_cache.stats().items()})
+        if async_translator:
+            instrumentation.merge({f'async_{name}': value for name, value in async_translator.stats().items()})
+        if compiled_cache:
+            compiled_cache.close()
+        if journal:
+            journal.close()
+            instrumentation.count('journal_resumed', journal.resumed)
+            instrumentation.count('journal_checkpoints', journal.checkpoints)
+        instrumentation.finish()
+
+    @classmethod
+    def create_translator(cls, translation_cache_path: Optional[Path]):
+        return GoogleTranslate(translation_cache_path=translation_cache_path)
+
+    @classmethod
+    def create_timed_translator(cls, translation_cache_path: Optional[Path],
+                                instrumentation: Optional[Instrumentation]):
+        translator = cls.create_translator(translation_cache_path)
+        return TimedTranslator(translator, instrumentation) if instrumentation else translator
+
+    @classmethod
+    def create_journaled_translator(cls, translation_cache_path: Optional[Path],
+                                    instrumentation: Optional[Instrumentation],
+                                    journal: Optional[TranslationJournal]):
+        translator = cls.create_timed_translator(translation_cache_path, instrumentation)
+        return JournaledTranslator(translator, journal) if journal else translator
+
+    @classmethod
+    def create_cached_translator(cls, translation_cache_path: Optional[Path],
+                                 memory_cache: Optional[MemoryTranslationCache],
+                                 instrumentation: Optional[Instrumentation] = None,
+                                 compiled_cache: Optional[CompiledTranslationCache] = None,
+                                 journal: Optional[TranslationJournal] = None):
+        translator = cls.create_journaled_translator(translation_cache_path, instrumentation, journal)
+        if compiled_cache:
+            translator = CompiledCacheTranslator(translator, compiled_cache)
+        return CachedTranslator(translator, memory_cache) if memory_cache else translator
 
-        # Load the original map
-        with open(input_path, 'r', encoding='utf-8') as file:
-            input_map = yaml.full_load(file)
+    @classmethod
+    def translate_in_batches(cls, input_map, translation_cache_path, batch_size, batch_chars, concurrency,
+                             memory_cache=None, instrumentation=None, compiled_cache=None, journal=None,
+                             batch_translator=None):
+        if instrumentation:
+            input_map = TimedMap(input_map, instrumentation)
 
-        output_map = []
+        texts = collect_translation_texts(input_map)
+        translations = translate_texts(texts, translation_cache_path,
+                                       lambda: cls.create_journaled_translator(translation_cache_path, instrumentation,
+                                                                               journal),
+                                       batch_size, batch_chars, concurrency, memory_cache, instrumentation,
+                                       [cache for cache in (compiled_cache, journal) if cache], batch_translator)
+
+        # Fan the translations back into the map, the same way the one by one path fills it
+        for file_entry in input_map:
+            for input_entry in record_entries(file_entry):
+                if 'translation_input' in input_entry and input_entry['translation_input']:
+                    translated_text = translations.get(input_entry['translation_input'])
+                    if translated_text is not None:
+                        input_entry['translated_text'] = translated_text
+
+                    if 'chunks' in input_entry and input_entry['chunks']:
+                        input_entry['chunks'] = [{'original': chunk, 'translated': translations[chunk]}
+                                                 for chunk in input_entry['chunks']
+                                                 if translations.get(chunk) is not None]
+
+            if UNIT_KEY in file_entry:
+                yield file_entry
+                continue
+
+            yield {
+                "file": file_entry["file"],
+                "map": file_entry['map']
+            }
+
+    @classmethod
+    def translate_one_by_one(cls, input_map, translation_cache_path, memory_cache=None, instrumentation=None,
+                             compiled_cache=None, journal=None):
+        if instrumentation:
+            input_map = TimedMap(input_map, instrumentation)
+
+        google_translator = cls.create_cached_translator(translation_cache_path, memory_cache, instrumentation,
+                                                         compiled_cache, journal)
+        try:
+            yield from cls.translate_entries(input_map, google_translator)
+        finally:
+            google_translator.close()
+
+    @classmethod
+    def translate_entries(cls, input_map, google_translator):
         # Load the translated map
         for i, file_entry in enumerate(input_map):
             output_map_entries = []
-            for j, input_entry in enumerate(file_entry['map']):
+            for j, input_entry in enumerate(record_entries(file_entry)):
                 if 'translation_input' in input_entry and input_entry['translation_input']:
                     translation_input = input_entry['translation_input']
                     translated_text = google_translator.execute(text=translation_input)
@@ -43,13 +199,25 @@ class Translate(Flow):
 
                 output_map_entries.append(input_entry)
 
-            output_map.append({
+            # A unit record was translated in place
+            if UNIT_KEY in file_entry:
+                yield file_entry
+                continue
+
+            yield {
                 "file": file_entry["file"],
                 "map": output_map_entries
-            })
+            }
 
-        with open(output_path, 'w+', encoding='utf-8') as output_file:
-            yaml.dump(output_map, output_file, allow_unicode=True, default_style='', default_flow_style=False)
 
-        google_translator.close()
-        print(f"Successfully translated input and written output to: {output_path}")
+class TimedMap:
+    """
+    Re-iterable view of a map that times reading its records as the deserialization stage.
+    """
+
+    def __init__(self, input_map, instrumentation: Instrumentation):
+        self.input_map = input_map
+        self.instrumentation = instrumentation
+
+    def __iter__(self):
+        return self.instrumentation.timed_iter(self.input_map, 'deserialization')
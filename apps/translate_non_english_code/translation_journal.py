@@ -0,0 +1,122 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from translate_non_english_code.build_translation_cache import CREATE_TRANSLATIONS_TABLE_SQL, UPSERT_TRANSLATION_SQL
+
+
+class TranslationJournal:
+    """
+    Append-only JSON lines journal of the translations a Translate run completed. Every checkpoint_every
+    translations the pending ones are appended and fsynced, and upserted into the SQLite translation
+    cache when there is one, so a run that dies loses at most the translations since the last checkpoint.
+    With resume the completed translations of the previous run are loaded and are not requested again.
+    Safe to share between the threads of a batch translation.
+    """
+
+    def __init__(self, journal_path: Path, checkpoint_every: int = 100, resume: bool = False,
+                 translation_cache_path: Optional[Path] = None):
+        self.journal_path = journal_path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.translation_cache_path = translation_cache_path
+        self.completed = TranslationJournal.load(journal_path) if resume else {}
+        self.resumed = len(self.completed)
+        self.checkpoints = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._file = open(journal_path, 'a' if resume else 'w', encoding='utf-8')
+        self._connection = None
+        if translation_cache_path:
+            # checkpoints run on whichever translation thread fills the interval
+            self._connection = sqlite3.connect(translation_cache_path, check_same_thread=False)
+            self._connection.execute(CREATE_TRANSLATIONS_TABLE_SQL)
+            self._connection.commit()
+
+    @classmethod
+    def load(cls, journal_path: Path) -> dict:
+        """
+        Reads the completed translations of a journal, cutting off a last line torn by a crash
+        so the lines appended from here on stay whole.
+        """
+        completed = {}
+        if not os.path.exists(journal_path):
+            return completed
+
+        valid_length = 0
+        with open(journal_path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                completed[record['text']] = record['translation']
+                valid_length += len(line)
+
+        if valid_length != os.path.getsize(journal_path):
+            os.truncate(journal_path, valid_length)
+        return completed
+
+    def get(self, text: str) -> Optional[str]:
+        return self.completed.get(text)
+
+    def record(self, text: str, translated_text: str) -> None:
+        with self._lock:
+            self.completed[text] = translated_text
+            self._pending.append((text, translated_text))
+            if len(self._pending) >= self.checkpoint_every:
+                self._checkpoint()
+
+    def checkpoint(self) -> None:
+        with self._lock:
+            self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        if not self._pending:
+            return
+
+        for text, translated_text in self._pending:
+            self._file.write(json.dumps({'text': text, 'translation': translated_text}, ensure_ascii=False))
+            self._file.write('\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        if self._connection:
+            with self._connection:
+                self._connection.executemany(UPSERT_TRANSLATION_SQL, self._pending)
+
+        self._pending = []
+        self.checkpoints += 1
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._file.close()
+        if self._connection:
+            self._connection.close()
+
+
+class JournaledTranslator:
+    """
+    Puts a journal in front of a translator, keeping its execute/close interface: translations completed
+    before a resume are returned from the journal, new ones are recorded in it.
+    """
+
+    def __init__(self, translator, journal: TranslationJournal):
+        self.translator = translator
+        self.journal = journal
+
+    def execute(self, text: str) -> Optional[str]:
+        translated_text = self.journal.get(text)
+        if translated_text is not None:
+            return translated_text
+
+        translated_text = self.translator.execute(text=text)
+        if translated_text is not None:
+            self.journal.record(text, translated_text)
+        return translated_text
+
+    def close(self) -> None:
+        # a failing run still gets what it translated since the last checkpoint
+        self.journal.checkpoint()
+        self.translator.close()
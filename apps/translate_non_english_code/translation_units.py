@@ -0,0 +1,75 @@
+# Key of the unit records of an interned map, and of the file map entries referring to them
+UNIT_KEY = 'unit'
+# Fields of a map entry that only depend on its original text, and so move to the unit record
+UNIT_FIELDS = ['original_text', 'translation_input', 'chunks', 'translated_text']
+
+
+def record_entries(record):
+    """
+    The entries of a map record that carry texts: a unit record is an entry of its own.
+    """
+    return [record] if UNIT_KEY in record else record['map']
+
+
+class TranslationUnitIndex:
+    """
+    Project-wide interning of map entries by original text. Every unique text becomes a unit record,
+    written once before the first file record that refers to it, and the file map entries keep only
+    the unit id, their positions and line count.
+    """
+
+    def __init__(self):
+        self.unit_ids = {}
+        self.references = 0
+
+    def intern(self, file_map):
+        """
+        Returns the unit records first seen in the file map and the file map referring to units.
+        """
+        units = []
+        interned_map = []
+        for entry in file_map:
+            original_text = entry['original_text']
+            unit_id = self.unit_ids.get(original_text)
+            if unit_id is None:
+                unit_id = len(self.unit_ids) + 1
+                self.unit_ids[original_text] = unit_id
+                unit = {UNIT_KEY: unit_id}
+                unit.update((field, entry[field]) for field in UNIT_FIELDS if field in entry)
+                units.append(unit)
+
+            reference = {UNIT_KEY: unit_id, 'positions': entry['positions']}
+            if 'line_count' in entry:
+                reference['line_count'] = entry['line_count']
+            interned_map.append(reference)
+
+        self.references += len(interned_map)
+        return units, interned_map
+
+
+def resolve_units(records):
+    """
+    Yields the file records of a map with the units they refer to filled in, the same entries a map
+    written without units has. Maps without unit records pass through unchanged.
+    """
+    units = {}
+    for record in records:
+        if UNIT_KEY in record:
+            units[record[UNIT_KEY]] = record
+            continue
+
+        if units:
+            record = {'file': record['file'], 'map': [resolve_entry(entry, units) for entry in record['map']]}
+        yield record
+
+
+def resolve_entry(entry, units):
+    if UNIT_KEY not in entry:
+        return entry
+
+    unit = units[entry[UNIT_KEY]]
+    resolved = {field: unit[field] for field in UNIT_FIELDS if field in unit}
+    resolved['positions'] = entry['positions']
+    if 'line_count' in entry:
+        resolved['line_count'] = entry['line_count']
+    return resolved
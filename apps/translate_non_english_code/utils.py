@@ -1,4 +1,5 @@
 import configparser
+import functools
 import re
 
 # Regex for non-English characters (outside Basic Latin and Latin-1 Supplement)
@@ -8,6 +9,13 @@ NON_ENGLISH_CHUNK = r'\b([\w]*?[^A-Za-z0-9\s,.?!;:\'\"(){}[\]/\\@#$%^&*+=<>_`~|\
 
 WHOLE_LINE_PATTERN = r'^(.*)$'
 
+# Size of the memo of analyze_text
+TEXT_ANALYSIS_CACHE_SIZE = 1 << 16
+
+# Any byte outside printable ASCII and the ASCII characters matched by \s. A file without such bytes is
+# english or technical on every line and has no full width characters, so it can never produce a map entry.
+NON_TECHNICAL_BYTE_PATTERN = re.compile(rb'[^\t\n\x0b\x0c\r\x1c-\x1f\x20-\x7e]')
+
 __SQL_COMMENT_PATTERN = r'--(.*?)$'
 __SINGLE_LINE_COMMENT_PATTERN = r'/[/]+(.*?)$'
 __PYTHON_COMMENT_PATTERN = r'[#]+(.*?)$'
@@ -15,18 +23,35 @@ __SINGLE_QUOTED_STRING_PATTERN = r"'(.*?)'"
 __DOUBLE_QUOTED_STRING_PATTERN = r'"(.*?)"'
 __TICK_QUOTED_STRING_PATTERN = r'`(.*?)`'
 
-# THESE WOULD NEED A DIFFERENT STYLE OF PROCESSING... FOR NOW LET IT LINE BY LINE PROCESSING
+# Block comments and docstrings that open and close on the same line
 __MULTILINE_COMMENT_PATTERN_1 = r'/\*(.*?)\*/'
 __MULTILINE_COMMENT_PATTERN_2 = r'^[\s]*[*](.*?)$'
 __SINGLE_QUOTE_DOCSTRING_PATTERN = r"'''(.*?)'''"
 __DOUBLE_QUOTE_DOCSTRING_PATTERN = r'"""(.*?)"""'
 
+# Block comments and docstrings left open at the end of a line; CodeScanner.tokenize carries them over
+# the following lines until the closing delimiter
+__MULTILINE_COMMENT_OPEN_PATTERN = r'/\*((?:(?!\*/).)*)$'
+__SINGLE_QUOTE_DOCSTRING_OPEN_PATTERN = r"'''((?:(?!''').)*)$"
+__DOUBLE_QUOTE_DOCSTRING_OPEN_PATTERN = r'"""((?:(?!""").)*)$'
+
+# Closing delimiter of every block opening pattern
+BLOCK_CLOSERS = {
+    __MULTILINE_COMMENT_OPEN_PATTERN: '*/',
+    __SINGLE_QUOTE_DOCSTRING_OPEN_PATTERN: "'''",
+    __DOUBLE_QUOTE_DOCSTRING_OPEN_PATTERN: '"""',
+}
+
+# Order in which pattern types are tried at the same position of a line
+PATTERN_CHECK_SEQUENCE = ['single_line_comment', 'multi_line_comment', 'multi_line_string', 'single_line_string']
+
 # Supported file extensions and their comment/string patterns
 LANG_PATTERNS = {
     '.sql': {
         'single_line_comment': [__SQL_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__SINGLE_QUOTED_STRING_PATTERN],
     },
     '.json': {
@@ -77,30 +102,35 @@ LANG_PATTERNS = {
         'single_line_comment': [__SINGLE_LINE_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__DOUBLE_QUOTED_STRING_PATTERN],
     },
     '.h': {
         'single_line_comment': [__SINGLE_LINE_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__DOUBLE_QUOTED_STRING_PATTERN],
     },
     '.hpp': {
         'single_line_comment': [__SINGLE_LINE_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__DOUBLE_QUOTED_STRING_PATTERN],
     },
     '.c': {
         'single_line_comment': [__SINGLE_LINE_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__DOUBLE_QUOTED_STRING_PATTERN],
     },
     '.cpp': {
         'single_line_comment': [__SINGLE_LINE_COMMENT_PATTERN,
                                 __MULTILINE_COMMENT_PATTERN_1,
                                 __MULTILINE_COMMENT_PATTERN_2],
+        'multi_line_comment': [__MULTILINE_COMMENT_OPEN_PATTERN],
         'single_line_string': [__DOUBLE_QUOTED_STRING_PATTERN],
     },
     '.proto': {
@@ -111,53 +141,203 @@ LANG_PATTERNS = {
         'single_line_comment': [__PYTHON_COMMENT_PATTERN,
                                 __SINGLE_QUOTE_DOCSTRING_PATTERN,
                                 __DOUBLE_QUOTE_DOCSTRING_PATTERN],
+        'multi_line_string': [__SINGLE_QUOTE_DOCSTRING_OPEN_PATTERN,
+                              __DOUBLE_QUOTE_DOCSTRING_OPEN_PATTERN],
         'single_line_string': [__SINGLE_QUOTED_STRING_PATTERN,
                                __DOUBLE_QUOTED_STRING_PATTERN],
     }
 }
 
 
+class CodeScanner:
+    """
+    Finds the comment and string spans of a line in a single left-to-right pass.
+
+    All the patterns of a file type are compiled once into one alternation, ordered by
+    PATTERN_CHECK_SEQUENCE, so at any position a comment wins over a string. A comment marker
+    inside an earlier string (e.g. "http://...") is therefore part of the string, not a comment.
+    """
+
+    def __init__(self, patterns):
+        alternatives = [pattern for pattern_type in PATTERN_CHECK_SEQUENCE
+                        for pattern in patterns.get(pattern_type, [])]
+        # every pattern has exactly one group, so match.lastindex tells which one matched
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in alternatives),
+                                re.DOTALL) if alternatives else None
+        # group of every block opening pattern -> the delimiter that closes the block
+        self.block_closers = {group: BLOCK_CLOSERS[pattern] for group, pattern in enumerate(alternatives, 1)
+                              if pattern in BLOCK_CLOSERS}
+
+    def scan(self, content):
+        """
+        Returns the matched spans in order of appearance and the line with the spans removed.
+        """
+        if self.regex is None:
+            return [], content
+
+        spans = []
+        remainder = []
+        last_end = 0
+        for match in self.regex.finditer(content):
+            spans.append(match.group(match.lastindex))
+            remainder.append(content[last_end:match.start()])
+            last_end = match.end()
+
+        if not spans:
+            return spans, content
+
+        remainder.append(content[last_end:])
+        return spans, ''.join(remainder)
+
+    def tokenize(self, lines):
+        """
+        Yields (line_number, line_count, text) for the spans of every line, followed by the rest of the
+        line outside the spans. A block comment or docstring left open on a line is carried over the
+        lines that follow and yielded once it is closed, as a single span starting on its first line.
+        """
+        line_number = 0
+        block = None
+        block_start = 0
+        closer = None
+        for content in lines:
+            line_number += 1
+            if block is not None:
+                end = content.find(closer)
+                if end == -1:
+                    block.append(content)
+                    continue
+
+                block.append(content[:end])
+                yield block_start, line_number - block_start + 1, ''.join(block)
+                block = None
+                content = content[end + len(closer):]
+
+            if self.regex is None:
+                yield line_number, 1, content
+                continue
+
+            remainder = []
+            last_end = 0
+            for match in self.regex.finditer(content):
+                remainder.append(content[last_end:match.start()])
+                last_end = match.end()
+                if match.lastindex in self.block_closers:
+                    # an opening pattern runs to the end of the line, so this is the last match
+                    block = [match.group(match.lastindex)]
+                    block_start = line_number
+                    closer = self.block_closers[match.lastindex]
+                else:
+                    yield line_number, 1, match.group(match.lastindex)
+
+            remainder.append(content[last_end:])
+            yield line_number, 1, ''.join(remainder)
+
+        # a block still open at the end of the file runs to its last line
+        if block is not None:
+            yield block_start, line_number - block_start + 1, ''.join(block)
+
+
+CODE_SCANNERS = {file_ext: CodeScanner(patterns) for file_ext, patterns in LANG_PATTERNS.items()}
+
+# What precedes the text on a continuation line of a block: the ' * ' of a block comment, or indentation
+BLOCK_COMMENT_DECORATION_REGEX = re.compile(r'^[ \t]*\*(?!/)[ \t]?')
+BLOCK_INDENTATION_REGEX = re.compile(r'^[ \t]*')
+
+
+def split_block_decoration(text):
+    """
+    (prefixes, text without them) of a text spanning several lines, with the prefix of every line after
+    the first: its indentation and, when every non-blank one has it, the ' * ' of a block comment.
+    The translator gets the text alone; decorate_block puts the prefixes back on the translation.
+    """
+    lines = text.split('\n')
+    continuation_lines = [line for line in lines[1:] if line.strip()]
+    regex = BLOCK_COMMENT_DECORATION_REGEX if continuation_lines and all(
+        BLOCK_COMMENT_DECORATION_REGEX.match(line) for line in continuation_lines) else BLOCK_INDENTATION_REGEX
+
+    prefixes = []
+    undecorated_lines = [lines[0]]
+    for line in lines[1:]:
+        match = regex.match(line)
+        prefix = match.group(0) if match else ''
+        prefixes.append(prefix)
+        undecorated_lines.append(line[len(prefix):])
+    return prefixes, '\n'.join(undecorated_lines)
+
+
+def decorate_block(text, prefixes):
+    """
+    Puts the prefixes of split_block_decoration back on the lines after the first; lines a translation
+    added take the last non-blank prefix.
+    """
+    if not prefixes:
+        return text
+
+    lines = text.split('\n')
+    extra_prefix = next((prefix for prefix in reversed(prefixes) if prefix.strip()), prefixes[-1])
+    return '\n'.join([lines[0]] + [(prefixes[index] if index < len(prefixes) else extra_prefix) + line
+                                   for index, line in enumerate(lines[1:])])
+
+
 def is_english_or_technical(text):
     return not text or text == "" or re.match(ENGLISH_OR_TECHNICAL_PATTERN, text) is not None
 
 
 def find_non_english_chunks(text):
-    chunks = set()
+    # dict keeps the first-seen order, so the map output is stable across runs and processes
+    chunks = {}
     for match in re.finditer(NON_ENGLISH_CHUNK, text, re.DOTALL):
-        chunks.add(match.group(1))
+        chunks[match.group(1)] = None
 
     return list(chunks)
 
 
+# Mapping of full-width characters to their half-width equivalents
+FULL_WIDTH_TRANSLATION_TABLE = str.maketrans({
+    '，': ',',  # Full-width comma
+    '：': ':',  # Full-width colon
+    '；': ';',  # Full-width semicolon
+    '。': '.',  # Full-width period
+    '！': '!',  # Full-width exclamation mark
+    '？': '?',  # Full-width question mark
+    '（': '(',  # Full-width left parenthesis
+    '）': ')',  # Full-width right parenthesis
+    '【': '[',  # Full-width left square bracket
+    '】': ']',  # Full-width right square bracket
+    '《': '<',  # Full-width less than sign
+    '》': '>',  # Full-width greater than sign
+    '“': '"',  # Full-width double quote (left)
+    '”': '"',  # Full-width double quote (right)
+    '‘': "'",  # Full-width single quote (left)
+    '’': "'",  # Full-width single quote (right)
+    '－': '-',  # Full-width hyphen-minus
+    '—': '-',  # Full-width em dash
+    '–': '-',  # Full-width en dash
+    '、': ',',  # asian comma
+    '\u200B': '',  # non-breaking space
+    '\u03BC': '\u00B5',  # mu symbol
+    '\u00A0': ' ',  # Non-breaking space
+})
+
+
 def replace_full_width_chars(text):
-    # Mapping of full-width characters to their half-width equivalents
-    replacements = {
-        '，': ',',  # Full-width comma
-        '：': ':',  # Full-width colon
-        '；': ';',  # Full-width semicolon
-        '。': '.',  # Full-width period
-        '！': '!',  # Full-width exclamation mark
-        '？': '?',  # Full-width question mark
-        '（': '(',  # Full-width left parenthesis
-        '）': ')',  # Full-width right parenthesis
-        '【': '[',  # Full-width left square bracket
-        '】': ']',  # Full-width right square bracket
-        '《': '<',  # Full-width less than sign
-        '》': '>',  # Full-width greater than sign
-        '“': '"',  # Full-width double quote (left)
-        '”': '"',  # Full-width double quote (right)
-        '‘': "'",  # Full-width single quote (left)
-        '’': "'",  # Full-width single quote (right)
-        '－': '-',  # Full-width hyphen-minus
-        '—': '-',  # Full-width em dash
-        '–': '-',  # Full-width en dash
-        '、': ',',  # asian comma
-        '\u200B': '',  # non-breaking space
-        '\u03BC': '\u00B5',  # mu symbol
-        '\u00A0': ' ',  # Non-breaking space
-    }
+    # None of the characters to replace is ASCII
+    if text.isascii():
+        return text
+
+    return text.translate(FULL_WIDTH_TRANSLATION_TABLE)
 
-    for full_width, half_width in replacements.items():
-        text = text.replace(full_width, half_width)
 
-    return text
+@functools.lru_cache(maxsize=TEXT_ANALYSIS_CACHE_SIZE)
+def analyze_text(text):
+    """
+    (translation_input, chunks) of a text to translate, (translated_text, None) of a text that only had
+    full width characters replaced, or None when the text needs nothing. Memoized, since the same texts
+    (license headers, log messages) recur on many lines; chunks is a tuple so no caller can change it.
+    """
+    processed_text = replace_full_width_chars(text)
+    if not is_english_or_technical(processed_text):
+        return processed_text, tuple(find_non_english_chunks(processed_text))
+    if text != processed_text:
+        return processed_text, None
+    return None